@@ -0,0 +1,183 @@
+# In-memory serving of the broker's web assets.
+#
+# Every phone in a room loads the landing page and the room assets within a
+# few seconds of the code going up on the TV, so they are read, compressed
+# and hashed once rather than per request.  Files are re-read when their
+# mtime changes, so editing them does not need a broker restart.
+#
+# Nothing here depends on the web server; broker.py and asyncio-broker.py
+# wrap these in their own resources and handlers.
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from jinja2 import Template
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compressed encodings, most preferred first when the client gives several
+# the same q.
+ENCODINGS = [b'br', b'gzip']
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header names etag, by the weak comparison
+    the header calls for: W/ prefixes are ignored and * matches anything."""
+    if if_none_match.strip() == b'*':
+        return True
+    for tag in if_none_match.split(b','):
+        tag = tag.strip()
+        if tag.startswith(b'W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def encoding_qualities(accepted):
+    """Coding name -> q value, from an Accept-Encoding header."""
+    qualities = {}
+    for item in accepted.split(b','):
+        params = item.split(b';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition(b'=')
+            if key.strip().lower() == b'q':
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        qualities[name] = q
+    return qualities
+
+class CachedTemplate:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.template = None
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self.mtime:
+            with open(self.path, 'rb') as f:
+                self.template = Template(f.read().decode('utf-8'))
+            self.mtime = mtime
+        return self.template
+
+class LandingPage:
+    def __init__(self, path='index.html'):
+        self.template = CachedTemplate(path)
+        self.plain_page = None
+        self.plain_template = None
+
+    def render(self, room_prefill=None, message=None, nick=None):
+        template = self.template.get()
+        if room_prefill is None and message is None and nick is None:
+            # Most phones arrive with no arguments; render that page once.
+            if self.plain_template is not template:
+                self.plain_page = template.render(room_prefill=None, message=None, nick=None).encode('utf-8')
+                self.plain_template = template
+            return self.plain_page
+        return template.render(room_prefill=room_prefill, message=message, nick=nick).encode('utf-8')
+
+class CachedFile:
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self.mtime = None
+        self.content_type = (mimetypes.guess_type(path)[0] or 'application/octet-stream').encode('ascii')
+        if self.content_type.startswith(b'text/') or self.content_type == b'application/javascript':
+            self.content_type += b'; charset=utf-8'
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        self.etag = '"{}"'.format(hashlib.sha1(content).hexdigest()[:16]).encode('ascii')
+        # Encoding name -> body; compressed variants are only kept when they
+        # are actually smaller.
+        self.variants = {b'identity': content}
+        compressed = gzip.compress(content, 9)
+        if len(compressed) < len(content):
+            self.variants[b'gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < len(content):
+                self.variants[b'br'] = compressed
+        self.mtime = mtime
+
+    def respond(self, method, if_none_match, accepted):
+        """Returns the status, headers and body of a GET or HEAD.
+
+        ``if_none_match`` and ``accepted`` are the request's If-None-Match
+        and Accept-Encoding headers as bytes, or None.
+        """
+        self.load()
+        headers = [(b'content-type', self.content_type), (b'etag', self.etag),
+                (b'vary', b'accept-encoding')]
+        if self.max_age:
+            headers.append((b'cache-control', 'public, max-age={}'.format(self.max_age).encode('ascii')))
+        else:
+            headers.append((b'cache-control', b'no-cache'))
+
+        if if_none_match is not None and etag_matches(if_none_match, self.etag):
+            return 304, headers, b''
+
+        encoding = self.choose_encoding(accepted)
+        body = self.variants[encoding]
+        if encoding != b'identity':
+            headers.append((b'content-encoding', encoding))
+        headers.append((b'content-length', str(len(body)).encode('ascii')))
+        if method == b'HEAD':
+            return 200, headers, b''
+        return 200, headers, body
+
+    def choose_encoding(self, accepted):
+        """The variant the client gives the highest q.  Identity only
+        competes when it is listed; otherwise it is the fallback when no
+        compressed variant is acceptable."""
+        if not accepted:
+            return b'identity'
+        qualities = encoding_qualities(accepted)
+        anything = qualities.get(b'*', None)
+        best, best_q = b'identity', 0.0
+        for encoding in ENCODINGS + [b'identity']:
+            if encoding not in self.variants:
+                continue
+            if encoding == b'identity':
+                q = qualities.get(encoding, 0.0)
+            else:
+                q = qualities.get(encoding, anything or 0.0)
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+class CachedFiles:
+    """The files of one directory (not its subdirectories), held in memory.
+
+    HTML is served with ``no-cache``, so browsers revalidate it with its
+    ETag on every load and pick up a new deploy straight away.  Everything
+    else may be cached for ``max_age`` seconds.
+    """
+
+    def __init__(self, path, index='index.html', max_age=86400):
+        self.index = index
+        self.files = {}
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if os.path.isfile(full):
+                cached = CachedFile(full, 0 if name.endswith('.html') else max_age)
+                cached.load()
+                self.files[name] = cached
+
+    def get(self, name):
+        if name == '':
+            name = self.index
+        return self.files.get(name, None)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# requires aiohttp >= 3.11, jinja2; uvloop is used when installed
+#
+# The broker on asyncio and aiohttp instead of Twisted and Autobahn.  Rooms
+# and commands are brokercore's, the same as broker.py's, and it serves the
+# same /, /join, /room, /ws, /metrics and /queues routes, so bench-load.py
+# can drive either one (--engine asyncio).  Sharding between worker processes is only
+# available in broker.py.
+import argparse
+import asyncio
+import collections
+
+from aiohttp import web, WSMsgType
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import assets
+import eventlog
+import journal
+import metrics
+import validation
+
+from brokercore import Broker, join_location, queue_report
+from outbound import limit_send_buffer
+
+log = eventlog.get('broker.asyncio')
+
+class DelayedCall:
+    def __init__(self, loop, delay, f, args, kw):
+        self.called = False
+        self.handle = loop.call_later(delay, self.fire, f, args, kw)
+
+    def fire(self, f, args, kw):
+        self.called = True
+        f(*args, **kw)
+
+    def active(self):
+        return not self.called and not self.handle.cancelled()
+
+    def cancel(self):
+        self.handle.cancel()
+
+class AsyncioClock:
+    """The part of Twisted's reactor interface the Broker uses as a clock."""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kw):
+        return DelayedCall(self.loop, delay, f, args, kw)
+
+# aiohttp only waits for the transport to drain after this many bytes have
+# gone out (256KiB by default).  Kept small, flush() stalls as soon as the
+# transport's buffer is full, the way Twisted pauses its producer.
+WRITER_LIMIT = 4096
+
+class WebSocketConnection:
+    def __init__(self, broker, request, ws):
+        self.broker = broker
+        self.request = request
+        self.ws = ws
+        self.peer = "tcp:{}".format(request.remote)
+        self.participant = None
+        self.join_timer = None
+        # The frame taken off the outbound queue for flush() to write.  The
+        # queue is paused after every frame and resumed once it is written,
+        # so a socket that stops draining backs frames up into the queue.
+        self.wire = collections.deque()
+        self.flushing = None
+        self.outbound = broker.outbound_queue(self.write_frame, self.drop_slow_consumer)
+
+    def sendMessage(self, payload, isBinary=False, kind=None, key=None):
+        payload, isBinary = self.broker.outgoing(self, payload, isBinary)
+        self.outbound.send(payload, isBinary, kind, key)
+
+    def sendClose(self, code=None, reason=None):
+        asyncio.ensure_future(self.ws.close(code=code, message=(reason or '').encode('utf-8')))
+
+    def write_frame(self, payload, isBinary):
+        self.wire.append((payload, isBinary))
+        self.outbound.pauseProducing()
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        try:
+            while self.wire:
+                payload, isBinary = self.wire.popleft()
+                await self.ws.send_frame(payload, WSMsgType.BINARY if isBinary else WSMsgType.TEXT)
+                # The next queued frame, if any, comes back through write_frame.
+                self.outbound.resumeProducing()
+        except ConnectionError:
+            self.outbound.stopProducing()
+        finally:
+            self.flushing = None
+
+    def drop_slow_consumer(self):
+        log.warning('slow-consumer', peer=self.peer, dropped=self.outbound.dropped)
+        if self.request.transport is not None:
+            self.request.transport.abort()
+
+async def websocket(request):
+    broker = request.app['broker']
+    ws = web.WebSocketResponse(heartbeat=request.app['ping_interval'], compress=request.app['deflate'],
+            writer_limit=WRITER_LIMIT)
+    await ws.prepare(request)
+    limit_send_buffer(request.transport.get_extra_info('socket'))
+
+    connection = WebSocketConnection(broker, request, ws)
+    log.debug('connection-open', peer=connection.peer)
+    broker.connected(connection)
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                broker.handle_message(connection, msg.data.encode('utf-8'))
+            elif msg.type == WSMsgType.BINARY:
+                broker.handle_message(connection, msg.data, True)
+    finally:
+        log.debug('connection-lost', peer=connection.peer, code=ws.close_code)
+        connection.outbound.stopProducing()
+        if connection.flushing is not None:
+            connection.flushing.cancel()
+        broker.disconnected(connection)
+    return ws
+
+def query_arg(query, name):
+    value = query.get(name, None)
+    if value is not None and value:
+        return value
+    return None
+
+async def root_page(request):
+    query = request.query
+    body = request.app['landing_page'].render(room_prefill=query_arg(query, 'code'),
+            message=query_arg(query, 'message'), nick=query_arg(query, 'nick'))
+    return web.Response(body=body, content_type='text/html', charset='utf-8')
+
+async def join(request):
+    form = await request.post()
+    status, url = join_location(request.app['broker'], query_arg(form, 'code'), query_arg(form, 'nick'))
+    response = web.Response(status=status, headers={'Location': url})
+    if status == 307:
+        # As in broker.py: come back on a new connection to be routed again.
+        response.force_close()
+    return response
+
+async def metrics_page(request):
+    return web.Response(body=request.app['broker'].metrics.render(),
+            headers={'Content-Type': metrics.CONTENT_TYPE})
+
+async def queues_page(request):
+    return web.Response(body=queue_report(request.app['broker'], query_arg(request.query, 'top')),
+            content_type='application/json')
+
+async def room_file(request):
+    cached = request.app['room_files'].get(request.match_info['name'])
+    if cached is None:
+        raise web.HTTPNotFound()
+    status, headers, body = cached.respond(request.method.encode('ascii'),
+            request.headers.get('If-None-Match', '').encode('latin-1') or None,
+            request.headers.get('Accept-Encoding', '').encode('latin-1'))
+    response = web.Response(status=status, body=body)
+    for name, value in headers:
+        response.headers[name.decode('ascii')] = value.decode('latin-1')
+    return response
+
+async def room_redirect(request):
+    # Relative links in the index need the trailing slash.
+    raise web.HTTPFound('/room/')
+
+def build_app(broker, ping_interval=20, deflate=False):
+    app = web.Application()
+    app['broker'] = broker
+    app['ping_interval'] = ping_interval
+    app['deflate'] = deflate
+    app['landing_page'] = assets.LandingPage()
+    app['room_files'] = assets.CachedFiles('room')
+    app.router.add_get('/', root_page)
+    app.router.add_get('/ws', websocket)
+    app.router.add_get('/metrics', metrics_page)
+    app.router.add_get('/queues', queues_page)
+    app.router.add_post('/join', join)
+    app.router.add_get('/room', room_redirect)
+    app.router.add_get('/room/{name:[^/]*}', room_file)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Party Box prototype broker (asyncio)")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--state-dir', default=None,
+            help="directory to keep the room journal and snapshots in")
+    parser.add_argument('--send-overflow', choices=['disconnect', 'drop-oldest'], default='disconnect',
+            help="what to do when a slow client's outbound queue fills up")
+    parser.add_argument('--deflate', action='store_true',
+            help="accept permessage-deflate from clients that offer it")
+    parser.add_argument('--validate', choices=validation.MODES, default='strict',
+            help="check incoming commands against schemas/: all of them, a sample, or none")
+    eventlog.add_arguments(parser)
+    args = parser.parse_args()
+    eventlog.setup(args.log_level, args.log_format)
+
+    if uvloop is not None:
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    clock = AsyncioClock(loop)
+
+    room_journal = None
+    if args.state_dir is not None:
+        room_journal = journal.Journal(args.state_dir, clock)
+
+    broker = Broker(clock=clock, journal=room_journal, send_overflow=args.send_overflow,
+            validator=validation.Validator(args.validate))
+    # No access log: a line per request is what the event log is meant to avoid.
+    runner = web.AppRunner(build_app(broker, deflate=args.deflate), access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, port=args.port).start())
+    log.info('listening', port=args.port, loop="uvloop" if uvloop is not None else "asyncio")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(runner.cleanup())
+        if room_journal is not None:
+            room_journal.close()
+        loop.close()
+        eventlog.shutdown()
+
+if __name__ == '__main__':
+    main()
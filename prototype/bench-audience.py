@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# What a crowd voting on one question costs the Game: everyone joined as a
+# participant, each answer relayed to the Game, against everyone joined as
+# audience (capabilities/audience.rst), the votes tallied by the broker.
+# Reports the frames and bytes the Game receives for the joins and for the
+# votes, and the broker CPU time per vote.  Participants join with
+# participant-roster, or presence alone would swamp the bigger rooms.
+import time
+
+import codec
+import eventlog
+
+from brokercore import Broker
+from messages import CreateRoomMessage, JoinRoomMessage, SimpleMultiChoiceQuestion, \
+                     SimpleMultiChoiceAnswer
+
+ROOM_SIZES = [100, 1000, 10000]
+
+class Call:
+    def __init__(self, when, f, args):
+        self.when = when
+        self.f = f
+        self.args = args
+        self.cancelled = False
+
+    def active(self):
+        return not self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+class ManualClock:
+    # Time only moves when the bench says so.
+    def __init__(self):
+        self.now = 0.0
+        self.calls = []
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, f, *args):
+        call = Call(self.now + delay, f, args)
+        self.calls.append(call)
+        return call
+
+    def advance(self, seconds):
+        self.now += seconds
+        due = [ c for c in self.calls if c.when <= self.now and not c.cancelled ]
+        self.calls = [ c for c in self.calls if c.when > self.now and not c.cancelled ]
+        for call in due:
+            call.f(*call.args)
+
+class BenchConnection:
+    def __init__(self, peer):
+        self.peer = peer
+        self.participant = None
+        self.join_timer = None
+        self.frames = 0
+        self.bytes_received = 0
+        self.last = None
+
+    def sendMessage(self, payload, isBinary=False, kind=None, key=None):
+        self.frames += 1
+        self.bytes_received += len(payload)
+        self.last = payload
+
+def deliver(broker, connection, payload):
+    data = codec.decode(payload)
+    broker.invoke_command(data['command'], connection, data, payload)
+
+def run(size, audience):
+    clock = ManualClock()
+    broker = Broker(clock=clock)
+    game = BenchConnection("game")
+    deliver(broker, game, CreateRoomMessage(['multi-choice', 'participant-roster', 'audience'],
+        name="Game").encode())
+    code = codec.decode(game.last)['room-code']
+
+    capabilities = ['multi-choice', 'audience' if audience else 'participant-roster']
+    crowd = []
+    for i in range(size):
+        c = BenchConnection("phone{}".format(i))
+        deliver(broker, c, JoinRoomMessage(code, "Phone{}".format(i), capabilities=capabilities).encode())
+        crowd.append(c)
+    clock.advance(1)
+    joins = game.frames, game.bytes_received
+
+    q = SimpleMultiChoiceQuestion(code, None, "Would you rather?",
+            ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"])
+    deliver(broker, game, q.encode())
+    game.frames = game.bytes_received = 0
+    answers = [ SimpleMultiChoiceAnswer(code, "Game", q.question_id,
+        {'answer-identifier': q.choices[i % 2]['answer-identifier']}).encode() for i in range(size) ]
+
+    start = time.process_time()
+    for c, payload in zip(crowd, answers):
+        deliver(broker, c, payload)
+    cpu = time.process_time() - start
+    clock.advance(broker.audience_tally_interval)
+    return joins, (game.frames, game.bytes_received), cpu
+
+def main():
+    eventlog.setup('error')
+    print("{:>6} {:>12} {:>12} {:>12} {:>12} {:>12} {:>10}".format("size", "mode",
+        "join frames", "join bytes", "vote frames", "vote bytes", "us/vote"))
+    for size in ROOM_SIZES:
+        for mode, audience in (("participant", False), ("audience", True)):
+            joins, votes, cpu = run(size, audience)
+            print("{:>6} {:>12} {:>12} {:>12} {:>12} {:>12} {:>10.2f}".format(size, mode,
+                joins[0], joins[1], votes[0], votes[1], cpu * 1e6 / size))
+    eventlog.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# requires Twisted (the Broker's default clock)
+#
+# Compares one round of questions sent as per-player participant-messages
+# against a single broadcast-message, for a few room sizes.  Reports the
+# bytes the Game uploads and the broker CPU time spent decoding and
+# relaying them.
+import contextlib
+import io
+import time
+
+import codec
+
+from brokercore import Broker
+from messages import CreateRoomMessage, JoinRoomMessage, SimpleMultiChoiceQuestion
+
+ROOM_SIZES = [8, 100, 1000]
+ROUNDS = 20
+
+class BenchConnection:
+    def __init__(self, peer):
+        self.peer = peer
+        self.participant = None
+        self.join_timer = None
+        self.bytes_received = 0
+        self.last = None
+
+    def sendMessage(self, payload, isBinary=False, kind=None, key=None):
+        self.bytes_received += len(payload)
+        self.last = payload
+
+def deliver(broker, connection, payload):
+    data = codec.decode(payload)
+    broker.invoke_command(data['command'], connection, data, payload)
+
+def make_room(broker, size):
+    game = BenchConnection("game")
+    deliver(broker, game, CreateRoomMessage([], name="Game").encode())
+    code = codec.decode(game.last)['room-code']
+
+    players = []
+    for i in range(size):
+        c = BenchConnection("player{}".format(i))
+        deliver(broker, c, JoinRoomMessage(code, "Player{}".format(i)).encode())
+        players.append(c)
+    return code, game, players
+
+def run_round(broker, game, code, players, broadcast):
+    q = SimpleMultiChoiceQuestion(code, None, "What would Player0 rather?",
+            ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"])
+    uploaded = 0
+    start = time.process_time()
+    if broadcast:
+        payload = q.encode()
+        uploaded += len(payload)
+        deliver(broker, game, payload)
+    else:
+        for p in players:
+            q.participant = p.participant.name
+            payload = q.encode()
+            uploaded += len(payload)
+            deliver(broker, game, payload)
+    return uploaded, time.process_time() - start
+
+def main():
+    print("{:>6} {:>10} {:>14} {:>14}".format("size", "mode", "game bytes", "broker ms"))
+    for size in ROOM_SIZES:
+        broker = Broker()
+        with contextlib.redirect_stdout(io.StringIO()):
+            code, game, players = make_room(broker, size)
+        for mode, broadcast in (("per-player", False), ("broadcast", True)):
+            uploaded = 0
+            cpu = 0.0
+            for i in range(ROUNDS):
+                u, t = run_round(broker, game, code, players, broadcast)
+                uploaded += u
+                cpu += t
+            print("{:>6} {:>10} {:>14} {:>14.3f}".format(
+                size, mode, uploaded // ROUNDS, cpu * 1000 / ROUNDS))
+
+if __name__ == '__main__':
+    main()
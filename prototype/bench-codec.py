@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+#
+# Encode/decode throughput of each message class in messages.py, for every
+# JSON backend the codec module found installed.
+import time
+
+import codec
+import messages
+
+ITERATIONS = 20000
+
+def sample_messages():
+    question = messages.SimpleMultiChoiceQuestion("ABCD", "Player1", "Would you rather?",
+            ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"])
+    return [
+        messages.CreateRoomMessage(['multi-choice', 'static-message'], "Would You Rather 0.1", "WouldYouRather?"),
+        messages.CreateRoomResponseSuccess("ABCD", ['multi-choice', 'static-message'], server_agent="Prototype Broker"),
+        messages.CreateRoomResponseFailure(405, "Room capability foo not supported by clients (or broker).",
+            ['multi-choice', 'static-message'], server_agent="Prototype Broker"),
+        messages.JoinRoomMessage("ABCD", "Player1", user_agent="room 0.0", capabilities=['multi-choice']),
+        messages.JoinRoomResponseSuccess("WouldYouRather?", capabilities=['multi-choice', 'static-message'],
+            server_agent="Prototype Broker"),
+        messages.JoinRoomResponseFailure(404, "No room with that code exists"),
+        messages.ParticipantStatusMessage("ABCD", "Player1", "connected"),
+        messages.ParticipantRosterEntry("Player1", "connected"),
+        question,
+        messages.SimpleMultiChoiceAnswer("ABCD", "WouldYouRather?", question.question_id, question.choices[0]),
+        messages.StaticMessage("ABCD", "Player1",
+            '<span style="color:green">Correct!</span> Player2, Player3 got it right.', is_html=True),
+    ]
+
+def throughput(fn, arg):
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        fn(arg)
+    return ITERATIONS / (time.perf_counter() - start)
+
+def main():
+    print("{:<28} {:>8} {:>14} {:>14}".format("message", "backend", "encode/s", "decode/s"))
+    for m in sample_messages():
+        for name in sorted(codec.backends):
+            codec.use(name)
+            payload = m.encode()
+            enc = throughput(lambda m: m.encode(), m)
+            dec = throughput(codec.decode, payload)
+            print("{:<28} {:>8} {:>14.0f} {:>14.0f}".format(type(m).__name__, name, enc, dec))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# requires msgpack
+#
+# Bytes on the wire for each message type in messages.py, as JSON and with
+# the compact-encoding capability, each with and without permessage-deflate.
+# Sizes include the WebSocket frame header of a server-to-client frame;
+# deflate is applied to each message on its own (no context takeover),
+# which is the least it saves.
+import zlib
+
+import codec
+import compact
+
+from messages import CreateRoomMessage, CreateRoomResponseSuccess, CreateRoomResponseFailure, \
+                     JoinRoomMessage, JoinRoomResponseSuccess, JoinRoomResponseFailure, \
+                     ParticipantStatusMessage, ParticipantRosterEntry, SimpleMultiChoiceQuestion, \
+                     SimpleMultiChoiceAnswer, StaticMessage
+
+CAPABILITIES = ['multi-choice', 'static-message', 'participant-roster']
+
+MESSAGES = [
+    CreateRoomMessage(CAPABILITIES, "Would You Rather", "WouldYouRather"),
+    CreateRoomResponseSuccess("QXWP", CAPABILITIES, "Prototype Broker"),
+    CreateRoomResponseFailure(405, "Room capability x not supported by clients (or broker).",
+        CAPABILITIES, "Prototype Broker"),
+    JoinRoomMessage("QXWP", "Player12", "Mozilla/5.0 (iPhone)", CAPABILITIES),
+    JoinRoomResponseSuccess("WouldYouRather", CAPABILITIES, server_agent="Prototype Broker"),
+    JoinRoomResponseFailure(404, "No room with that code exists"),
+    ParticipantStatusMessage("QXWP", "Player12", "connected"),
+    ParticipantRosterEntry("Player12", "connected"),
+    SimpleMultiChoiceQuestion("QXWP", "Player12", "What would Player3 rather?",
+        ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"]),
+    SimpleMultiChoiceAnswer("QXWP", "WouldYouRather", "GTULRu06", "KU2b"),
+    StaticMessage("QXWP", "Player12", "Player3 would rather fight one horse-sized duck. You got it!"),
+]
+
+def frame_size(payload):
+    if len(payload) < 126:
+        return len(payload) + 2
+    if len(payload) < 65536:
+        return len(payload) + 4
+    return len(payload) + 10
+
+def deflate(payload):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    # RFC 7692: the trailing empty block of the sync flush is left off.
+    return (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+def main():
+    columns = ["json", "json+deflate", "compact", "compact+deflate"]
+    print("{:<28}".format("message") + "".join("{:>16}".format(c) for c in columns))
+    totals = [0] * len(columns)
+    for message in MESSAGES:
+        json_payload = message.encode()
+        compact_payload = compact.encode(codec.decode(json_payload))
+        sizes = [ frame_size(p) for p in (json_payload, deflate(json_payload),
+            compact_payload, deflate(compact_payload)) ]
+        totals = [ t + s for t, s in zip(totals, sizes) ]
+        print("{:<28}".format(type(message).__name__) + "".join("{:>16}".format(s) for s in sizes))
+    print("{:<28}".format("total") + "".join("{:>16}".format(t) for t in totals))
+    print("{:<28}".format("vs json") + "".join("{:>16.0%}".format(t / totals[0]) for t in totals))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# requires Twisted
+#
+# Journal write overhead per recorded message, and snapshot load time for a
+# few broker sizes.
+import shutil
+import tempfile
+import time
+
+from twisted.internet.task import Clock
+
+import journal
+
+RECORDS = 200000
+SIZES = [(100, 8), (1000, 8), (1000, 100)]
+
+def write_overhead(directory):
+    clock = Clock()
+    j = journal.Journal(directory, clock)
+    j.load()
+    start = time.perf_counter()
+    for i in range(RECORDS):
+        j.record('join', "ABCD", name="Player{}".format(i))
+        if i % 1000 == 999:
+            # A flush every 1000 records stands in for the write-behind timer.
+            clock.advance(j.flush_interval)
+    j.close()
+    return (time.perf_counter() - start) / RECORDS
+
+def load_time(directory, rooms, size):
+    state = {}
+    for r in range(rooms):
+        code = "R{:06d}".format(r)
+        state[code] = {'code': code, 'creator': "Game", 'capabilities': ['multi-choice', 'static-message'],
+                'participants': ["Player{}".format(i) for i in range(size)]}
+
+    clock = Clock()
+    j = journal.Journal(directory, clock)
+    j.load()
+    j.state_provider = lambda: state
+    j.snapshot()
+    j.close()
+
+    start = time.perf_counter()
+    loaded = journal.Journal(directory, Clock()).load()
+    elapsed = time.perf_counter() - start
+    assert len(loaded) == rooms
+    return elapsed
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        print("journal write: {:.2f}us per record".format(write_overhead(directory) * 1e6))
+        shutil.rmtree(directory)
+        for rooms, size in SIZES:
+            print("snapshot load: {} rooms x {} participants in {:.1f}ms".format(
+                rooms, size, load_time(directory, rooms, size) * 1000))
+            shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# requires autobahn, Twisted
+#
+# Load generator for the broker.  Simulates many Games, each with a room
+# full of phones, driving create/join/question/answer/disconnect cycles
+# with the encoders from messages.py, and reports relay latency, message
+# rate and the broker's memory and CPU use as JSON so that runs can be
+# compared across versions.
+#
+#   ./bench-load.py --spawn-broker --games 50 --players 20 --rounds 5
+#   ./bench-load.py --spawn-broker --engine asyncio --games 50 --players 20 --rounds 5
+#
+# Memory and CPU are read from /proc, so they are only reported on Linux
+# when the broker's pid is known (--spawn-broker or --broker-pid).
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from twisted.internet.endpoints import clientFromString
+from autobahn.twisted.websocket import WebSocketClientFactory
+from autobahn.twisted.websocket import WebSocketClientProtocol
+
+import codec
+from messages import CreateRoomMessage, JoinRoomMessage, SimpleMultiChoiceQuestion, \
+                     SimpleMultiChoiceAnswer, StaticMessage
+
+ENGINES = {'twisted': 'broker.py', 'asyncio': 'asyncio-broker.py'}
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.relayed = 0
+        self.frames = 0
+        self.games_done = 0
+        self.errors = 0
+        # question id -> time it was sent, and (question id, name) -> time
+        # the answer was sent; every simulated client shares this process.
+        self.question_sent = {}
+        self.answer_sent = {}
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+class SimClient(WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.sim.onOpen(self)
+
+    def onMessage(self, payload, isBinary):
+        self.factory.sim.stats.frames += 1
+        self.factory.sim.onMessage(codec.decode(payload))
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.sim.onClose()
+
+def connect(sim, endpoint, url):
+    from twisted.internet import reactor
+    factory = WebSocketClientFactory(url)
+    factory.protocol = SimClient
+    factory.sim = sim
+    clientFromString(reactor, endpoint).connect(factory).addErrback(sim.failed)
+
+class SimPhone:
+    def __init__(self, game, name):
+        self.game = game
+        self.stats = game.stats
+        self.name = name
+        self.connection = None
+
+    def start(self):
+        connect(self, self.game.endpoint, "{}?code={}".format(self.game.url, self.game.room))
+
+    def failed(self, reason):
+        self.stats.errors += 1
+
+    def onOpen(self, connection):
+        self.connection = connection
+        connection.sendMessage(JoinRoomMessage(self.game.room, self.name,
+            user_agent="bench-load phone", capabilities=['multi-choice', 'static-message']).encode())
+
+    def onMessage(self, msg):
+        if 'question-identifier' in msg:
+            now = time.monotonic()
+            qid = msg['question-identifier']
+            self.stats.latencies.append(now - self.stats.question_sent[qid])
+            self.stats.relayed += 1
+            self.stats.answer_sent[(qid, self.name)] = time.monotonic()
+            self.connection.sendMessage(SimpleMultiChoiceAnswer(self.game.room, msg['from'],
+                qid, msg['choices'][0]).encode())
+        elif 'static-message' in msg:
+            self.connection.sendClose()
+
+    def onClose(self):
+        pass
+
+class SimGame:
+    def __init__(self, stats, endpoint, url, index, players, rounds, on_done):
+        self.stats = stats
+        self.endpoint = endpoint
+        self.url = url
+        self.name = "Game{}".format(index)
+        self.players = players
+        self.rounds = rounds
+        self.on_done = on_done
+        self.room = None
+        self.joined = 0
+        self.answers = 0
+        self.question = None
+
+    def start(self):
+        connect(self, self.endpoint, self.url)
+
+    def failed(self, reason):
+        self.stats.errors += 1
+        self.finish()
+
+    def onOpen(self, connection):
+        self.connection = connection
+        connection.sendMessage(CreateRoomMessage(['multi-choice', 'static-message'],
+            "bench-load game", self.name).encode())
+
+    def onMessage(self, msg):
+        command = msg.get('command', None)
+        if command == 'create-room-response':
+            if msg['status'] != 0:
+                self.stats.errors += 1
+                self.connection.sendClose()
+                return
+            self.room = msg['room-code']
+            for i in range(self.players):
+                SimPhone(self, "Phone{}".format(i)).start()
+        elif command == 'participant-status':
+            if msg['presence'] == 'connected':
+                self.joined += 1
+                if self.joined == self.players:
+                    self.ask()
+            else:
+                self.joined -= 1
+                if self.joined == 0:
+                    self.connection.sendClose()
+        elif command == 'participant-message':
+            now = time.monotonic()
+            key = (msg['question-identifier'], msg['from'])
+            self.stats.latencies.append(now - self.stats.answer_sent.pop(key))
+            self.stats.relayed += 1
+            self.answers += 1
+            if self.answers == self.players:
+                self.ask()
+
+    def ask(self):
+        if self.question is not None:
+            del self.stats.question_sent[self.question.question_id]
+        if self.rounds == 0:
+            self.connection.sendMessage(StaticMessage(self.room, None, "Thanks for playing").encode())
+            return
+        self.rounds -= 1
+        self.answers = 0
+        self.question = SimpleMultiChoiceQuestion(self.room, None, "Would you rather?",
+                ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"])
+        self.stats.question_sent[self.question.question_id] = time.monotonic()
+        self.connection.sendMessage(self.question.encode())
+
+    def onClose(self):
+        self.finish()
+
+    def finish(self):
+        if self.on_done is not None:
+            self.on_done()
+            self.on_done = None
+
+def proc_usage(pid):
+    """Returns (rss bytes, cpu seconds) of a process, from /proc."""
+    with open('/proc/{}/status'.format(pid)) as f:
+        rss = 0
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return rss, (int(fields[11]) + int(fields[12])) / ticks
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    from twisted.internet import reactor
+
+    parser = argparse.ArgumentParser(description="Broker load generator")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--ramp', type=float, default=1.0,
+            help="seconds over which the games are started")
+    parser.add_argument('--spawn-broker', action='store_true',
+            help="start a broker on --port for the run")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='twisted',
+            help="which broker --spawn-broker starts")
+    parser.add_argument('--broker-pid', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=300,
+            help="give up on games that have not finished after this many seconds")
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    args = parser.parse_args()
+
+    broker = None
+    broker_pid = args.broker_pid
+    if args.spawn_broker:
+        broker = subprocess.Popen([sys.executable, ENGINES[args.engine], '--port', str(args.port)],
+                stdout=subprocess.DEVNULL)
+        broker_pid = broker.pid
+        time.sleep(1)
+
+    endpoint = "tcp:{}:{}".format(args.host, args.port)
+    url = "ws://{}:{}/ws".format(args.host, args.port)
+    stats = Stats()
+    remaining = [args.games]
+
+    def game_done():
+        stats.games_done += 1
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            reactor.stop()
+
+    usage_before = proc_usage(broker_pid) if broker_pid is not None else None
+    peak_rss = [0]
+    def sample():
+        if broker_pid is not None:
+            peak_rss[0] = max(peak_rss[0], proc_usage(broker_pid)[0])
+            reactor.callLater(0.5, sample)
+
+    for i in range(args.games):
+        game = SimGame(stats, endpoint, url, i, args.players, args.rounds, game_done)
+        reactor.callLater(args.ramp * i / args.games, game.start)
+    sample()
+    reactor.callLater(args.timeout, reactor.stop)
+
+    start = time.monotonic()
+    reactor.run()
+    elapsed = time.monotonic() - start
+
+    report = {
+        'revision': git_revision(),
+        'engine': args.engine if args.spawn_broker else None,
+        'games': args.games,
+        'players': args.players,
+        'rounds': args.rounds,
+        'games_completed': stats.games_done,
+        'errors': stats.errors,
+        'wall_seconds': elapsed,
+        'relayed_messages': stats.relayed,
+        'frames_received': stats.frames,
+        'messages_per_second': stats.relayed / elapsed,
+        'relay_latency_ms': {
+            'p50': stats.percentile(0.50),
+            'p99': stats.percentile(0.99),
+            'max': stats.percentile(1.0),
+        },
+    }
+    if usage_before is not None:
+        usage_after = proc_usage(broker_pid)
+        connections = args.games * (args.players + 1)
+        report['broker_peak_rss_bytes'] = peak_rss[0]
+        report['broker_rss_per_connection_bytes'] = (peak_rss[0] - usage_before[0]) / connections
+        report['broker_cpu_seconds'] = usage_after[1] - usage_before[1]
+
+    if broker is not None:
+        broker.terminate()
+        broker.wait()
+
+    output = json.dumps(report, indent=4)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# requires Twisted (the Broker's default clock)
+#
+# Broker memory per connected participant: joins rooms full of players and
+# reports the memory the broker allocated for them, not counting the
+# connection objects themselves (those belong to autobahn).
+import contextlib
+import io
+import tracemalloc
+
+import codec
+
+from brokercore import Broker
+from messages import CreateRoomMessage, JoinRoomMessage
+
+PARTICIPANTS = 100000
+ROOM_SIZES = [8, 100, 1000]
+
+class BenchConnection:
+    __slots__ = ('peer', 'participant', 'join_timer', 'last')
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.participant = None
+        self.join_timer = None
+        self.last = None
+
+    def sendMessage(self, payload, isBinary=False, kind=None, key=None):
+        self.last = payload
+
+def deliver(broker, connection, payload):
+    data = codec.decode(payload)
+    broker.invoke_command(data['command'], connection, data, payload)
+
+def bytes_per_participant(room_size):
+    broker = Broker()
+    rooms = PARTICIPANTS // room_size
+    games = [ BenchConnection("game{}".format(i)) for i in range(rooms) ]
+    players = [ BenchConnection("player{}".format(i)) for i in range(rooms * room_size) ]
+    creates = [ CreateRoomMessage(['multi-choice'], name="Game").encode() for i in range(rooms) ]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for r, game in enumerate(games):
+            deliver(broker, game, creates[r])
+            code = codec.decode(game.last)['room-code']
+            for p in players[r * room_size:(r + 1) * room_size]:
+                deliver(broker, p, JoinRoomMessage(code, p.peer).encode())
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    broker.timers.stop()
+    return rooms, used / (rooms * (room_size + 1))
+
+def main():
+    print("{:>6} {:>8} {:>22}".format("size", "rooms", "bytes per participant"))
+    for size in ROOM_SIZES:
+        rooms, per = bytes_per_participant(size)
+        print("{:>6} {:>8} {:>22.0f}".format(size, rooms, per))
+
+if __name__ == '__main__':
+    main()
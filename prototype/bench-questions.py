@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#
+# Time the reactor spends picking each round's question: reading the whole
+# pack and choosing one at random (what would-you-rather.py used to do)
+# against drawing from a QuestionBank deck, for a few pack sizes.  Also
+# reports how long building the bank takes, which happens once at startup
+# or on a reload thread.
+import json
+import os
+import random
+import tempfile
+import time
+
+import questionbank
+
+PACK_SIZES = [100, 10000, 100000]
+ROUNDS = 200
+
+def write_pack(directory, size):
+    path = os.path.join(directory, 'pack{}.json'.format(size))
+    with open(path, 'w') as f:
+        json.dump([ {"choices": ["Fight {} horse-sized ducks".format(i),
+            "Fight {} duck-sized horses".format(i * 100)],
+            "tags": ["animals"] if i % 3 else ["animals", "silly"]} for i in range(size) ], f)
+    return path
+
+def load_and_choose(path):
+    with open(path, 'rb') as qfile:
+        return random.choice(json.load(qfile))
+
+def main():
+    print("{:>8} {:>16} {:>14} {:>14}".format("size", "load+choice us", "draw us", "bank load ms"))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in PACK_SIZES:
+            path = write_pack(directory, size)
+
+            start = time.perf_counter()
+            for i in range(ROUNDS):
+                load_and_choose(path)
+            old = (time.perf_counter() - start) / ROUNDS
+
+            start = time.perf_counter()
+            bank = questionbank.QuestionBank([path])
+            loaded = time.perf_counter() - start
+
+            deck = bank.deck()
+            start = time.perf_counter()
+            for i in range(ROUNDS):
+                deck.draw()
+            new = (time.perf_counter() - start) / ROUNDS
+
+            print("{:>8} {:>16.1f} {:>14.2f} {:>14.1f}".format(size, old * 1e6, new * 1e6, loaded * 1000))
+
+if __name__ == '__main__':
+    main()
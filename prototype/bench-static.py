@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# requires autobahn, Twisted, jinja2
+#
+# Requests per second for the landing page and the room assets, rendered
+# in-process, with the per-request template compile and twisted's File
+# (as the broker used to serve them) against the cached resources.
+import time
+
+from twisted.web.resource import Resource, getChildForRequest
+from twisted.web.static import File
+from twisted.web.test.requesthelper import DummyRequest
+
+from jinja2 import Template
+
+from broker import build_root
+
+REQUESTS = 2000
+PATHS = [b'/', b'/room/', b'/room/prettyprint.js', b'/room/style.css']
+
+class UncachedRootPage(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        with open('index.html', 'rb') as idxfile:
+            page = Template(idxfile.read().decode('utf-8'))
+        return page.render(room_prefill=None, message=None, nick=None).encode('utf-8')
+
+def uncached_root():
+    root = Resource()
+    root.putChild(b"", UncachedRootPage())
+    root.putChild(b"room", File('room'))
+    return root
+
+def requests_per_second(root, path, encoding):
+    start = time.perf_counter()
+    for i in range(REQUESTS):
+        request = DummyRequest(path.split(b'/')[1:])
+        if encoding is not None:
+            request.requestHeaders.addRawHeader(b'accept-encoding', encoding)
+        resource = getChildForRequest(root, request)
+        resource.render(request)
+    return REQUESTS / (time.perf_counter() - start)
+
+def main():
+    roots = [("before", uncached_root(), None), ("after", build_root(), None),
+            ("after+gzip", build_root(), b'gzip, br')]
+    print("{:<24} {:>12} {:>12}".format("path", "version", "requests/s"))
+    for path in PATHS:
+        for name, root, encoding in roots:
+            print("{:<24} {:>12} {:>12.0f}".format(path.decode('ascii'), name,
+                requests_per_second(root, path, encoding)))
+
+if __name__ == '__main__':
+    main()
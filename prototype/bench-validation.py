@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+#
+# Cost of checking incoming commands against schemas/, per message, next
+# to the cost of decoding the same message, for the commands the broker
+# receives.
+import time
+
+import codec
+import validation
+
+from messages import CreateRoomMessage, JoinRoomMessage, SimpleMultiChoiceQuestion, \
+                     SimpleMultiChoiceAnswer, StaticMessage
+
+ITERATIONS = 20000
+REPEATS = 5
+
+MESSAGES = [
+    ("create-room", CreateRoomMessage(['multi-choice', 'static-message'], "Would You Rather", "Game")),
+    ("join-room", JoinRoomMessage("QXWP", "Player12", "Mozilla/5.0 (iPhone)", ['multi-choice'])),
+    ("question", SimpleMultiChoiceQuestion("QXWP", "Player12", "What would Player3 rather?",
+        ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"])),
+    ("broadcast question", SimpleMultiChoiceQuestion("QXWP", None, "What would Player3 rather?",
+        ["Fight one horse-sized duck", "Fight a hundred duck-sized horses"])),
+    ("answer", SimpleMultiChoiceAnswer("QXWP", "Game", "GTULRu06", {"answer-identifier": "KU2b"})),
+    ("static message", StaticMessage("QXWP", "Player12", "You got it!")),
+]
+
+def per_message(f, arg):
+    # The best of a few runs, to keep other work on the machine out of it.
+    best = None
+    for r in range(REPEATS):
+        start = time.perf_counter()
+        for i in range(ITERATIONS):
+            f(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e9 / ITERATIONS
+
+def main():
+    start = time.perf_counter()
+    validator = validation.Validator('strict')
+    print("compiled {} command schemas in {:.1f}ms".format(len(validator.checks),
+        (time.perf_counter() - start) * 1000))
+    sampled = validation.Validator('sampled')
+
+    print("{:<20} {:>10} {:>10} {:>10} {:>10}".format("message", "decode ns", "strict ns",
+        "sampled ns", "of decode"))
+    for name, message in MESSAGES:
+        payload = message.encode()
+        data = codec.decode(payload)
+        assert validator.check(data) is None, validator.check(data)
+        decode = per_message(codec.decode, payload)
+        strict = per_message(validator.check, data)
+        sample = per_message(sampled.check, data)
+        print("{:<20} {:>10.0f} {:>10.0f} {:>10.0f} {:>10.0%}".format(name, decode, strict,
+            sample, strict / decode))
+
+if __name__ == '__main__':
+    main()
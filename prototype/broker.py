@@ -1,350 +1,121 @@
 #/usr/bin/env python3
 # requires autobahn, Twisted, jinja2
-import json
-import random
-from urllib.parse import urlunsplit, quote_plus
-
 from twisted.web.resource import Resource
+from twisted.web.server import Site
 from twisted.web.util import redirectTo
 
 from autobahn.twisted.websocket import WebSocketServerProtocol
 
-from jinja2 import Template
-
-from messages import JoinRoomResponseSuccess, \
-                     JoinRoomResponseFailure, \
-                     CreateRoomResponseSuccess, \
-                     CreateRoomResponseFailure, \
-                     ParticipantStatusMessage
-
-class Broker:
-    server_agent = "Prototype Broker"
-    client_capabilities = ['multi-choice', 'static-message']
-    broker_capabilities = []
-
-    def __init__(self):
-        self.rooms = {}
+import assets
+import eventlog
+import journal
+import metrics
+import shards
+import validation
 
-    def has_command(self, command_name):
-        return command_name in self.commands
+from brokercore import Broker, join_location, queue_report
+from outbound import limit_send_buffer
 
-    def invoke_command(self, command_name, connection, data):
-        return self.commands.get(command_name, self.log_unknown)(self, connection, data)
-
-    def log_unknown(self, connection, data):
-        print("Connection from {} tried to invoke a command that was not implemented: {}".format(
-            connection.peer, data))
-
-    def generate_room_code(self):
-        alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        code = None
-        while code is  None or code in self.rooms:
-            code = ''.join( random.choice(alphabet) for i in range(4) )
-        return code
-
-    def disconnected(self, connection):
-        if connection.participant is not None and connection.participant.room is not None:
-            room = connection.participant.room
-            room.broadcast_status(connection.participant, 'disconnected')
-            room.remove_participant(connection)
-        else:
-            pass # Was not joined to a room, nothing to do.
-
-    def create_room(self, connection, data):
-        try:
-            if 'participant-name' in data:
-                creator_name = data['participant-name']
-            else:
-                creator_name = "RoomCreator"
-
-            code = self.generate_room_code()
-
-            if 'capabilities' not in data:
-                response = CreateRoomResponseFailure(400, 
-                    "Room capabilities were not specified.", 
-                    self.client_capabilities, server_agent=self.server_agent)
-                connection.sendMessage(response.encode())
-                return
-
-            for cap in data['capabilities']:
-                if cap not in self.client_capabilities and cap not in self.broker_capabilities:
-                    response = CreateRoomResponseFailure(405,
-                            "Room capability {} not supported by clients (or broker).".format(cap),
-                            self.client_capabilities, server_agent=self.server_agent)
-                    connection.sendMessage(response.encode())
-                    return
-
-            response = CreateRoomResponseSuccess(code, data['capabilities'], server_agent=self.server_agent)
-
-            creator = Participant(creator_name, connection)
-            self.rooms[code] = Room(code, creator, data['capabilities'])
-
-            connection.sendMessage(response.encode())
-            print("Room {} created by \"{}\" ({}) capabilities: {}".format(
-                code, creator_name, data.get("user-agent", None), data['capabilities']))
-        except Exception as e:
-            print("Error processing create-room request: {}".format(e))
-            response = CreateRoomResponseFailure(500, str(e), self.client_capabilities, server_agent=self.server_agent)
-            connection.sendMessage(response.encode())
-
-
-    def join_room(self, connection, data): 
-        try:
-            code = data.get('room-code', None)
-            if code is None or code not in self.rooms:
-                connection.sendMessage(JoinRoomResponseFailure(404,
-                    "No room with that code exists").encode())
-                return
-
-            room = self.rooms[code]
-
-            participant_name = data.get('participant-name', None)
-            if participant_name is None:
-                connection.sendMessage(JoinRoomResponseFailure(400,
-                    "No name provided when joining room.").encode())
-                return
-
-            capabilities = data.get('capabilities', None)
-            if capabilities is not None:
-                for cap in room.capabilities:
-                    if cap not in capabilities:
-                        connection.sendMessage(JoinRoomResponseFailure(405,
-                            "This client does not support capability {}, refuse to join room {}".format(
-                                cap, code), server_agent=self.server_agent, capabilities=room.capabilities).encode())
-                        return
-
-
-            participant = Participant(participant_name, connection)
-            try:
-                room.add_participant(participant)
-                room.broadcast_status(participant, 'connected')
-                
-                response = JoinRoomResponseSuccess(room.creator.name,
-                        capabilities=room.capabilities, server_agent=self.server_agent)                
-                connection.sendMessage(response.encode())
-
-            except Exception as e:
-                print("Error adding participant: {}".format(e))
-                response = JoinRoomResponseFailure(500, str(e), server_agent=self.server_agent)
-                connection.sendMessage(response.encode())
-                return
-
-        except Exception as e:
-            print("Error processing join-room request: {}".format(e))
-            response = JoinRoomResponseFailure(500, str(e), server_agent=self.server_agent)
-            connection.sendMessage(response.encode())
-
-    def participant_message(self, connection, data):
-        try:
-            code = data['room-code']
-            if code not in self.rooms:
-                print("Error, room {} does not exist".format(code))
-                return
-
-            room = self.rooms[code]
-
-            sender = None
-            recipient = None
-            for p in room.participants.values():
-                if p.connection is connection:
-                    sender = p
-                elif p.name == data['participant-name']:
-                    recipient = p
-
-            if sender is None:
-                print("Error, room {} participant with connection {} could not be mapped to a name.".format(connection))
-                return
-            if recipient is None:
-                print("Error, room {} could not find participants {} for message delivery".format(code, data['participant-name']))
-                return
-
-            if 'from' in data:
-                if sender.name != data['from']:
-                    print("Error, sender {} in room {} tried to impersonate {}".format(sender.name, code, data['from']))
-                    return
-            else:
-                data['from'] = sender.name
-
-            recipient.connection.sendMessage( 
-                    json.dumps(data, ensure_ascii=False).encode('utf-8')
-            )
-
-        except Exception as e:
-            print("Error processing participant-message: {}".format(e))
-
-
-
-Broker.commands = {
-    'create-room':  Broker.create_room,
-    'join-room': Broker.join_room,
-    'participant-message': Broker.participant_message,
-}
-
-class Room:
-    def __init__(self, code, creator, capabilities=None):
-        self.code = code
-        self.creator = creator
-        self.creator.room = self
-        self.participants = {creator.name:creator}
-        if capabilities is None:
-            self.capabilities = []
-        else:
-            self.capabilities = capabilities
-
-    def remove_participant(self, connection):
-        del self.participants[connection.participant.name]
-        print("ROOM {}: {} has disconnected".format(self.code, connection.participant.name))
-        connection.participant = None
-
-    def add_participant(self, participant):
-        if participant.name in self.participants:
-            print("ROOM {}: Participant with name {} already connected.".format(self.code, participant.name))
-            raise RuntimeError("Participant with that name is already connected.")
-
-        self.participants[participant.name] = participant
-        participant.room = self
-        print("ROOM {}: {} has connected".format(self.code, participant.name))
-
-        for name, obj in self.participants.items():
-            if obj.connection is not participant.connection:
-                status_msg = {"command": "participant-status",
-                        "participant-name": obj.name,
-                        "room-code": self.code,
-                        "presence": "connected"}
-                participant.connection.sendMessage(json.dumps(status_msg).encode('utf-8'))
-
-
-    def broadcast_status(self, participant, status):
-        status_msg = {'command': 'participant-status',
-                'participant-name': participant.name,
-                'room-code': self.code,
-                'presence': status}
-
-        for name, obj in self.participants.items():
-            if obj.connection is not participant.connection:
-                obj.connection.sendMessage(json.dumps(status_msg).encode('utf-8'))
-
-class Participant:
-    def __init__(self, name, connection):
-        self.name = name
-        self.connection = connection
-        connection.participant = self
-        self.room = None
+log = eventlog.get('broker.twisted')
 
 class ParticipantConnection(WebSocketServerProtocol):
     broker = None
 
     def onConnect(self, request):
-        print("Connection from {}".format(request.peer))
+        log.debug('connection', peer=request.peer)
         self.peer = request.peer
         self.participant = None
+        self.join_timer = None
 
     def onOpen(self):
-        print("Connection ready from {}".format(self.peer))
-
-    def onMessage(self, payload, isBinary):
-        if isBinary:
-            print("Received binary message from {} that is not supported.".format(self.peer))
-            return
+        log.debug('connection-open', peer=self.peer)
+        self.outbound = self.broker.outbound_queue(self.write_frame, self.drop_slow_consumer)
+        if hasattr(self.transport, 'getHandle'):
+            limit_send_buffer(self.transport.getHandle())
         try:
-            data = json.loads(payload.decode("utf-8"))
-        except Exception as e:
-            print("Error processing message from peer {}: {}".format(
-                self.peer, e))
-            return
-
-        if 'command' not in data:
-            print("Error, the message received did not have a command")
-            return
+            self.transport.registerProducer(self.outbound, True)
+        except RuntimeError:
+            # The HTTP channel that upgraded the connection is still
+            # registered as the transport's producer.
+            self.transport.unregisterProducer()
+            self.transport.registerProducer(self.outbound, True)
+        self.broker.connected(self)
+
+    def sendMessage(self, payload, isBinary=False, kind=None, key=None):
+        payload, isBinary = self.broker.outgoing(self, payload, isBinary)
+        outbound = getattr(self, 'outbound', None)
+        if outbound is None:
+            return WebSocketServerProtocol.sendMessage(self, payload, isBinary)
+        outbound.send(payload, isBinary, kind, key)
+
+    def write_frame(self, payload, isBinary):
+        WebSocketServerProtocol.sendMessage(self, payload, isBinary)
+
+    def drop_slow_consumer(self):
+        log.warning('slow-consumer', peer=self.peer, dropped=self.outbound.dropped)
+        self.dropConnection(abort=True)
 
+    def onMessage(self, payload, isBinary):
         if self.broker is None:
-            print("Error, no broker is available.")
+            log.error('no-broker', peer=self.peer)
             return
 
-        if self.broker.has_command(data['command']):
-            return self.broker.invoke_command(data['command'], self, data)
-
-        print("Error, not implemented command {}:\n{}".format(data['command'], data))
+        return self.broker.handle_message(self, payload, isBinary)
 
     def onClose(self, wasClean, code, reason):
-        print("Connection lost from {}: ".format(self.peer, reason))
+        log.debug('connection-lost', peer=self.peer, code=code, reason=reason)
         self.broker.disconnected(self)
 
-def make_error_redirect(msg, request):
-    url = "/?message={}".format(quote_plus(msg))
-    code = request.args.get(b"code", [None])[0]
-    if code:
-        url += "&code={}".format(quote_plus(code))
-    nick = request.args.get(b'nick', [None])[0]
-    if nick:
-        url += "&nick={}".format(quote_plus(nick))
-
-    return redirectTo(url.encode('utf-8'), request)
+def arg(request, name):
+    value = request.args.get(name, [None])[0]
+    if value is not None and value:
+        return value.decode('utf-8')
+    return None
 
 class RoomJoinResource(Resource):
     isLeaf = True
 
     def render_POST(self, request):
-        code = request.args.get(b"code", [None])[0]
-        nick = request.args.get(b"nick", [None])[0]
-        if code is None or not code:
-            print("No room code supplied")
-            return make_error_redirect("No room code supplied!", request)
-        else:
-            code = code.decode("utf-8").strip()
-        if nick is None or not nick:
-            print("No nickname supplied")
-            return make_error_redirect("No nickname supplied!", request)
-        else:
-            nick = nick.decode("utf-8").strip()
-
-        if not nick or not code:
-            print("Nickname or code was empty string")
-            return make_error_redirect("Nickname or room code were empty!", request)
+        status, url = join_location(ParticipantConnection.broker, arg(request, b"code"), arg(request, b"nick"))
+        if status != 302:
+            # The master only routes a connection by its first request, so
+            # the browser has to come back on a new one to reach the worker
+            # with the room.
+            request.setHeader(b"connection", b"close")
+            request.setResponseCode(status)
+            request.setHeader(b"location", url.encode('ascii'))
+            return b""
+        return redirectTo(url.encode('ascii'), request)
 
-        code = code.upper()
-        if len(nick) > 20:
-            nick = nick[:20]
 
-        if code not in ParticipantConnection.broker.rooms:
-            return make_error_redirect("Room {} does not exist".format(code), request)
+class MetricsResource(Resource):
+    isLeaf = True
 
-        #room_url = "/room#code:{code};nick:{nick}".format(code=code, nick=nick)
-        room_url = ('', '', '/room', '', 'code:{code};nick:{nick}'.format(code=quote_plus(code), nick=quote_plus(nick)))
-        print("room_url {}".format(room_url))
-        url = urlunsplit(room_url)
-        print("url {}".format(url))
-        return redirectTo(url.encode('ascii'), request)
+    def render_GET(self, request):
+        request.setHeader(b"content-type", metrics.CONTENT_TYPE.encode('ascii'))
+        return ParticipantConnection.broker.metrics.render()
 
 
-class RootPage(Resource):
+class QueuesResource(Resource):
     isLeaf = True
 
     def render_GET(self, request):
-        request.responseHeaders.addRawHeader(b"Content-Type", b"text/html; charset=utf-8")
-        room_prefill = request.args.get(b'code', [None])[0]
+        request.setHeader(b"content-type", b"application/json")
+        return queue_report(ParticipantConnection.broker, arg(request, b"top"))
 
-        if room_prefill is not None and room_prefill:
-            room_prefill = room_prefill.decode('utf-8')
-        else:
-            room_prefil = None
 
-        message = request.args.get(b'message', [None])[0]
-        if message is not None and message:
-            message = message.decode('utf-8')
-        else:
-            message = None
+class RootPage(Resource):
+    isLeaf = True
 
-        nick = request.args.get(b'nick', [None])[0]
-        if nick is not None and nick:
-            nick = nick.decode("utf-8")
-        else:
-            nick = None
+    def __init__(self, path='index.html'):
+        Resource.__init__(self)
+        self.page = assets.LandingPage(path)
+
+    def render_GET(self, request):
+        request.responseHeaders.addRawHeader(b"Content-Type", b"text/html; charset=utf-8")
+        return self.page.render(room_prefill=arg(request, b'code'), message=arg(request, b'message'),
+                nick=arg(request, b'nick'))
 
-        with open('index.html', 'rb') as idxfile:
-            page = Template(idxfile.read().decode('utf-8'))
-        return page.render(room_prefill=room_prefill, message=message, nick=nick).encode('utf-8')
-        
 
     def getChild(self, name, request):
         if name == '':
@@ -353,33 +124,157 @@ class RootPage(Resource):
             return Resource.getChild(self, name, request)
 
 
-def main():
-    import sys
-    from twisted.python import log
-    from twisted.internet import reactor
-    from twisted.web.server import Site
-    from twisted.web.static import File
-    from autobahn.twisted.resource import WebSocketResource
-    from autobahn.twisted.websocket import WebSocketServerFactory
+class CachedFileResource(Resource):
+    isLeaf = True
 
-    log.startLogging(sys.stdout)
+    def __init__(self, cached):
+        Resource.__init__(self)
+        self.cached = cached
+
+    def render_GET(self, request):
+        status, headers, body = self.cached.respond(request.method,
+                request.getHeader(b'if-none-match'), request.getHeader(b'accept-encoding'))
+        request.setResponseCode(status)
+        for name, value in headers:
+            request.setHeader(name, value)
+        return body
+
+    render_HEAD = render_GET
+
+class CachedDirectory(Resource):
+    def __init__(self, path, index='index.html', max_age=86400):
+        Resource.__init__(self)
+        self.index = index.encode('utf-8')
+        self.files = { name.encode('utf-8'): CachedFileResource(cached)
+                for name, cached in assets.CachedFiles(path, index, max_age).files.items() }
+
+    def getChild(self, name, request):
+        if name == b'':
+            name = self.index
+        if name in self.files:
+            return self.files[name]
+        return Resource.getChild(self, name, request)
+
+    def render_GET(self, request):
+        # Relative links in the index need the trailing slash.
+        return redirectTo(request.path + b'/', request)
 
-    ParticipantConnection.broker = Broker()
+
+def accept_deflate(offers):
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+def build_root(ping_interval=20, ping_timeout=10, deflate=False):
+    from autobahn.twisted.resource import WebSocketResource
+    from autobahn.twisted.websocket import WebSocketServerFactory
 
     factory = WebSocketServerFactory()
     factory.protocol = ParticipantConnection
+    # Phones that drop off wifi rarely close their socket; an unanswered
+    # ping closes it for them.
+    factory.setProtocolOptions(autoPingInterval=ping_interval, autoPingTimeout=ping_timeout)
+    if deflate:
+        # Each compressing connection keeps its own zlib state, so this
+        # trades broker memory for bytes on the wire.
+        factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
 
     ws_resource = WebSocketResource(factory)
 
     root = Resource()
     root.putChild(b"", RootPage())
     root.putChild(b"ws", ws_resource)
+    root.putChild(b"metrics", MetricsResource())
+    root.putChild(b"queues", QueuesResource())
     root.putChild(b"join", RoomJoinResource())
-    root.putChild(b"room", File('room'))
+    root.putChild(b"room", CachedDirectory('room'))
+    return root
+
+class QuietSite(Site):
+    # Requests go to the event log at debug rather than an access log line
+    # for every one of them.
+    def log(self, request):
+        log.debug('request', peer=request.getClientAddress().host,
+                method=request.method.decode('ascii'), path=request.uri.decode('latin-1'),
+                code=request.code)
+
+twisted_log = eventlog.get('twisted')
+TWISTED_LEVELS = {'debug': 'debug', 'info': 'info', 'warn': 'warning', 'error': 'error',
+        'critical': 'error'}
+
+def log_twisted_event(event):
+    from twisted.logger import formatEvent
+    level = TWISTED_LEVELS.get(getattr(event.get('log_level', None), 'name', 'info'), 'info')
+    fields = {'system': event.get('log_system', event.get('system', '-'))}
+    if 'log_failure' in event:
+        fields['traceback'] = event['log_failure'].getTraceback()
+    getattr(twisted_log, level)(formatEvent(event), **fields)
 
-    site = Site(root)
-
-    reactor.listenTCP(9000, site)
+def main():
+    import argparse
+    import os
+    import sys
+    from twisted.internet import reactor
+    from twisted.logger import globalLogBeginner
+
+    parser = argparse.ArgumentParser(description="Party Box prototype broker")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--workers', type=int, default=1,
+            help="number of broker processes to shard rooms between")
+    parser.add_argument('--state-dir', default=None,
+            help="directory to keep the room journal and snapshots in")
+    parser.add_argument('--send-overflow', choices=['disconnect', 'drop-oldest'], default='disconnect',
+            help="what to do when a slow client's outbound queue fills up")
+    parser.add_argument('--deflate', action='store_true',
+            help="accept permessage-deflate from clients that offer it")
+    parser.add_argument('--validate', choices=validation.MODES, default='strict',
+            help="check incoming commands against schemas/: all of them, a sample, or none")
+    eventlog.add_arguments(parser)
+    # Used by the master process to start its workers.
+    parser.add_argument('--shard', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--control-fd', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.workers > 1 and args.shard is None:
+        command = [sys.executable, __file__, '--send-overflow', args.send_overflow]
+        if args.deflate:
+            command.append('--deflate')
+        command += ['--validate', args.validate, '--log-level', args.log_level,
+                '--log-format', args.log_format]
+        if args.state_dir is not None:
+            command += ['--state-dir', args.state_dir]
+        eventlog.setup(args.log_level, args.log_format)
+        try:
+            shards.run_master(args.port, args.workers, command)
+        finally:
+            eventlog.shutdown()
+        return
+
+    eventlog.setup(args.log_level, args.log_format)
+    globalLogBeginner.beginLoggingTo([log_twisted_event], redirectStandardIO=False)
+    reactor.addSystemEventTrigger('after', 'shutdown', eventlog.shutdown)
+
+    room_journal = None
+    if args.state_dir is not None:
+        state_dir = args.state_dir
+        if args.shard is not None:
+            state_dir = os.path.join(state_dir, 'shard-{}'.format(args.shard))
+        room_journal = journal.Journal(state_dir, reactor)
+        reactor.addSystemEventTrigger('before', 'shutdown', room_journal.close)
+
+    ParticipantConnection.broker = Broker(shard=args.shard or 0, shards=args.workers,
+            journal=room_journal, send_overflow=args.send_overflow,
+            validator=validation.Validator(args.validate))
+
+    site = QuietSite(build_root(deflate=args.deflate))
+
+    if args.control_fd is not None:
+        site.doStart()
+        shards.HandoffReader(reactor, args.control_fd, site).start()
+    else:
+        reactor.listenTCP(args.port, site)
     reactor.run()
 
 if __name__ == '__main__':
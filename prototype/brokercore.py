@@ -0,0 +1,877 @@
+# Rooms, participants and the broker's command dispatch, independent of the
+# web server in front of them (broker.py runs it on Twisted and Autobahn,
+# asyncio-broker.py on asyncio and aiohttp).
+#
+# A connection handed to the Broker needs a peer (for logging), participant
+# and join_timer attributes that start out as None, and two methods:
+#
+#   sendMessage(payload, isBinary=False, kind=None, key=None)
+#   sendClose(code, reason)
+#
+# The clock needs seconds() and callLater(delay, f, *args), returning a
+# call with active() and cancel(), the way Twisted's reactor does.
+import itertools
+import sys
+from time import perf_counter
+from urllib.parse import urlunsplit, quote_plus
+
+import brokerstate
+import codec
+import compact
+import eventlog
+import metrics
+import outbound
+import roomcodes
+import shards
+import timerwheel
+import validation
+
+from messages import JoinRoomResponseSuccess, \
+                     JoinRoomResponseFailure, \
+                     CreateRoomResponseSuccess, \
+                     CreateRoomResponseFailure, \
+                     ParticipantStatusMessage, \
+                     ParticipantRosterEntry, \
+                     AudienceTallyMessage
+
+log = eventlog.get('broker')
+
+class Broker:
+    server_agent = "Prototype Broker"
+    client_capabilities = ['multi-choice', 'static-message']
+    broker_capabilities = ['participant-roster', 'broker-state', 'multi-room', 'audience']
+    if compact.msgpack is not None:
+        broker_capabilities.append('compact-encoding')
+
+    def __init__(self, clock=None, roster_flush_window=0.05, shard=0, shards=1, journal=None,
+            broker_state=None, empty_room_grace=120, join_timeout=60,
+            send_overflow='disconnect', send_queue_frames=256, send_queue_bytes=1024 * 1024,
+            validator=None, audience_tally_interval=1.0):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.roster_flush_window = roster_flush_window
+        self.audience_tally_interval = audience_tally_interval
+        self.empty_room_grace = empty_room_grace
+        self.join_timeout = join_timeout
+        self.send_overflow = send_overflow
+        self.send_queue_frames = send_queue_frames
+        self.send_queue_bytes = send_queue_bytes
+        if validator is None:
+            validator = validation.Validator()
+        self.validator = validator
+        self.timers = timerwheel.TimerWheel(clock)
+        self.timers.start()
+        self.shard = shard
+        self.shards = shards
+        self.rooms = {}
+        # For connections hosting more than one room (multi-room), the
+        # creators of the rooms after their first, by room code.
+        self.hosted = {}
+        self.room_codes = roomcodes.RoomCodeAllocator(clock, self.code_letters())
+        if broker_state is None:
+            broker_state = brokerstate.BrokerStateStore()
+        self.broker_state = broker_state
+        self.journal = journal
+        if journal is not None:
+            self.restore(journal.load())
+            journal.state_provider = self.saved_state
+        self.metrics = metrics.BrokerMetrics(self)
+
+    def restore(self, state):
+        # Nobody is connected after a restart; the Game and Clients rejoin
+        # the restored rooms the same way they would after losing their own
+        # connection.
+        for code, saved in state.items():
+            room = Room(code, Participant(saved['creator'], None), saved['capabilities'],
+                    clock=self.clock, roster_flush_window=self.roster_flush_window)
+            room.expected.update(saved['participants'])
+            self.rooms[room.code] = room
+            self.room_codes.reserve(room.code)
+            room.reap_timer = self.timers.schedule(self.empty_room_grace, self.reap_room, code)
+            for name, value, message in saved.get('state', []):
+                self.broker_state.store(code, name, value, message.encode('utf-8'))
+        log.info('rooms-restored', rooms=len(state))
+
+    def saved_state(self):
+        return { code: {'code': code, 'creator': room.creator.name,
+                    'capabilities': room.capabilities,
+                    'participants': list(room.expected.union(room.participants)),
+                    'state': self.broker_state.saved_state(code)}
+                for code, room in self.rooms.items() }
+
+    def record(self, op, room, **fields):
+        if self.journal is not None:
+            self.journal.record(op, room, **fields)
+
+    def handle_message(self, connection, payload, isBinary=False):
+        metrics = self.metrics
+        metrics.received_frames += 1
+        metrics.received_bytes += len(payload)
+        if isBinary and compact.msgpack is None:
+            log.warning('binary-unsupported', peer=connection.peer)
+            metrics.bad_frames += 1
+            return
+        # Reading the clock costs more than the rest of the bookkeeping put
+        # together, so only a sample of messages is timed.
+        timed = not metrics.received_frames % metrics.sample_every
+        if timed:
+            start = perf_counter()
+        try:
+            if isBinary:
+                # Handlers re-encode the message as JSON where they need to.
+                data = compact.decode(payload)
+                payload = None
+            else:
+                data = codec.decode(payload)
+        except Exception as e:
+            log.warning('bad-frame', peer=connection.peer, error=str(e))
+            metrics.bad_frames += 1
+            return
+
+        if timed:
+            decoded = perf_counter()
+            (metrics.decode_compact if isBinary else metrics.decode_json).observe(decoded - start)
+
+        if not isinstance(data, dict) or not isinstance(data.get('command', None), str):
+            log.warning('no-command', peer=connection.peer)
+            metrics.bad_frames += 1
+            return
+
+        error = self.validator.check(data)
+        if error is not None:
+            metrics.reject(data['command'])
+            self.reject(connection, data, error)
+            return
+
+        count, seconds = metrics.command(data['command'])
+        count.value += 1
+        if self.has_command(data['command']):
+            if not timed:
+                return self.invoke_command(data['command'], connection, data, payload)
+            try:
+                return self.invoke_command(data['command'], connection, data, payload)
+            finally:
+                seconds.observe(perf_counter() - decoded)
+
+        log.warning('unknown-command', peer=connection.peer, command=data['command'])
+
+    def reject(self, connection, data, error):
+        log.warning('rejected', peer=connection.peer, command=data['command'], error=error)
+        if data['command'] == 'create-room':
+            connection.sendMessage(CreateRoomResponseFailure(400, error, self.client_capabilities,
+                server_agent=self.server_agent).encode())
+        elif data['command'] == 'join-room':
+            connection.sendMessage(JoinRoomResponseFailure(400, error,
+                server_agent=self.server_agent).encode())
+
+    def has_command(self, command_name):
+        return command_name in self.commands
+
+    def invoke_command(self, command_name, connection, data, payload=None):
+        return self.commands.get(command_name, Broker.log_unknown)(self, connection, data, payload)
+
+    def log_unknown(self, connection, data, payload=None):
+        log.warning('unknown-command', peer=connection.peer, command=data['command'])
+
+    def code_letters(self):
+        # With several broker workers the first letter picks the worker.
+        return shards.shard_letters(self.shard, self.shards)
+
+    def generate_room_code(self):
+        return sys.intern(self.room_codes.allocate())
+
+    def reap_room(self, code):
+        room = self.rooms.get(code, None)
+        if room is not None and room.empty():
+            self.remove_room(code)
+
+    def remove_room(self, code):
+        room = self.rooms.pop(code)
+        room.close()
+        self.broker_state.drop_room(code)
+        self.room_codes.release(code)
+        self.record('remove', code)
+        log.info('room-removed', room=code)
+
+    def owns_room_code(self, code):
+        return shards.shard_of(code, self.shards) == self.shard
+
+    def outbound_queue(self, write, disconnect):
+        return outbound.OutboundQueue(write, disconnect, self.send_queue_frames,
+                self.send_queue_bytes, self.send_overflow)
+
+    def encode(self, data):
+        start = perf_counter()
+        payload = codec.encode(data)
+        self.metrics.encode_json.observe(perf_counter() - start)
+        return payload
+
+    def outgoing(self, connection, payload, isBinary=False):
+        """The frame to write for payload on connection, translated for
+        connections that asked for compact-encoding."""
+        participant = connection.participant
+        if participant is not None and participant.compact and not isBinary:
+            start = perf_counter()
+            payload, isBinary = compact.translate(payload), True
+            self.metrics.encode_compact.observe(perf_counter() - start)
+        return payload, isBinary
+
+    def queue_stats(self, top=None):
+        """Each connection's outbound queue, deepest first; only the top
+        deepest if given."""
+        stats = []
+        for code, room in self.rooms.items():
+            for name, participant in itertools.chain(room.participants.items(), room.audience.items()):
+                queue = getattr(participant.connection, 'outbound', None)
+                if queue is not None:
+                    stats.append({'room-code': code, 'participant-name': name,
+                        'depth': queue.depth, 'bytes': queue.bytes, 'max-depth': queue.max_depth,
+                        'dropped': queue.dropped, 'coalesced': queue.coalesced})
+        stats.sort(key=lambda entry: (entry['depth'], entry['dropped']), reverse=True)
+        return stats[:top]
+
+    def connected(self, connection):
+        connection.join_timer = self.timers.schedule(self.join_timeout, self.evict_unjoined, connection)
+
+    def joined(self, connection, room):
+        if connection.join_timer is not None:
+            connection.join_timer.cancel()
+            connection.join_timer = None
+        if room.reap_timer is not None:
+            room.reap_timer.cancel()
+            room.reap_timer = None
+
+    def evict_unjoined(self, connection):
+        connection.join_timer = None
+        if connection.participant is None:
+            log.info('join-timeout', peer=connection.peer, seconds=self.join_timeout)
+            connection.sendClose(4008, "No room joined")
+
+    def disconnected(self, connection):
+        if connection.join_timer is not None:
+            connection.join_timer.cancel()
+            connection.join_timer = None
+        queue = getattr(connection, 'outbound', None)
+        if queue is not None:
+            self.metrics.closed_queue(queue)
+
+        if connection.participant is not None and connection.participant.room is not None:
+            self.leave(connection.participant)
+            connection.participant = None
+        else:
+            pass # Was not joined to a room, nothing to do.
+
+        for participant in self.hosted.pop(connection, {}).values():
+            self.leave(participant)
+
+    def leave(self, participant):
+        room = participant.room
+        if participant.audience:
+            if room.remove_audience(participant):
+                self.tally_later(room)
+        else:
+            self.metrics.presence_frames += room.broadcast_status(participant, 'disconnected')
+            self.record('leave', room.code, name=participant.name)
+            room.remove_participant(participant)
+        if room.empty():
+            # Kept for a while so the Game can reconnect to it.
+            room.reap_timer = self.timers.schedule(self.empty_room_grace, self.reap_room, room.code)
+
+    def may_host(self, connection, capabilities):
+        # A Game that created its room with multi-room can go on to create
+        # more on the same connection.
+        participant = connection.participant
+        return 'multi-room' in capabilities and participant.room is not None and \
+                participant.room.creator is participant and 'multi-room' in participant.room.capabilities
+
+    def participant_in(self, connection, room):
+        """The connection's participant in room, or None."""
+        participant = connection.participant
+        if participant is not None and participant.room is room:
+            return participant
+        hosted = self.hosted.get(connection, None)
+        if hosted is not None:
+            return hosted.get(room.code, None)
+        return None
+
+    def create_room(self, connection, data, payload=None):
+        code = None
+        try:
+            if 'participant-name' in data:
+                creator_name = data['participant-name']
+            else:
+                creator_name = "RoomCreator"
+
+            if 'capabilities' not in data:
+                response = CreateRoomResponseFailure(400, 
+                    "Room capabilities were not specified.", 
+                    self.client_capabilities, server_agent=self.server_agent)
+                connection.sendMessage(response.encode())
+                return
+
+            for cap in data['capabilities']:
+                if cap not in self.client_capabilities and cap not in self.broker_capabilities:
+                    response = CreateRoomResponseFailure(405,
+                            "Room capability {} not supported by clients (or broker).".format(cap),
+                            self.client_capabilities, server_agent=self.server_agent)
+                    connection.sendMessage(response.encode())
+                    return
+
+            if connection.participant is not None and not self.may_host(connection, data['capabilities']):
+                response = CreateRoomResponseFailure(409,
+                        "Already joined to room {}".format(connection.participant.room.code),
+                        self.client_capabilities, server_agent=self.server_agent)
+                connection.sendMessage(response.encode())
+                return
+
+            # Only once the request is known to be good, so refused requests
+            # do not use codes up.
+            code = self.generate_room_code()
+            response = CreateRoomResponseSuccess(code, data['capabilities'], server_agent=self.server_agent)
+
+            if connection.participant is None:
+                creator = Participant(creator_name, connection)
+            else:
+                # Not the connection's own participant, which stays the
+                # creator of its first room.
+                creator = Participant(creator_name, None)
+                creator.connection = connection
+                self.hosted.setdefault(connection, {})[code] = creator
+            creator.batched_roster = 'participant-roster' in data['capabilities']
+            creator.compact = 'compact-encoding' in data['capabilities']
+            self.rooms[code] = Room(code, creator, data['capabilities'],
+                    clock=self.clock, roster_flush_window=self.roster_flush_window)
+            self.joined(connection, self.rooms[code])
+
+            self.record('create', code, creator=creator_name, capabilities=data['capabilities'])
+            self.record('join', code, name=creator_name)
+
+            connection.sendMessage(response.encode())
+            log.info('room-created', room=code, creator=creator_name,
+                    user_agent=data.get("user-agent", None), capabilities=data['capabilities'])
+        except Exception as e:
+            log.error('create-room-failed', peer=connection.peer, error=str(e))
+            if code is not None and code not in self.rooms:
+                self.hosted.get(connection, {}).pop(code, None)
+                self.room_codes.release(code)
+            response = CreateRoomResponseFailure(500, str(e), self.client_capabilities, server_agent=self.server_agent)
+            connection.sendMessage(response.encode())
+
+
+    def join_room(self, connection, data, payload=None):
+        try:
+            code = data.get('room-code', None)
+            if code is None or code not in self.rooms:
+                connection.sendMessage(JoinRoomResponseFailure(404,
+                    "No room with that code exists").encode())
+                return
+
+            room = self.rooms[code]
+
+            participant_name = data.get('participant-name', None)
+            if participant_name is None:
+                connection.sendMessage(JoinRoomResponseFailure(400,
+                    "No name provided when joining room.").encode())
+                return
+
+            capabilities = data.get('capabilities', None)
+            if capabilities is not None:
+                for cap in room.capabilities:
+                    if cap not in capabilities and cap not in self.broker_capabilities:
+                        connection.sendMessage(JoinRoomResponseFailure(405,
+                            "This client does not support capability {}, refuse to join room {}".format(
+                                cap, code), server_agent=self.server_agent, capabilities=room.capabilities).encode())
+                        return
+
+
+            if connection.participant is not None:
+                connection.sendMessage(JoinRoomResponseFailure(409,
+                    "Already joined to room {}".format(connection.participant.room.code),
+                    server_agent=self.server_agent).encode())
+                return
+
+            participant = Participant(participant_name, connection)
+            participant.batched_roster = 'participant-roster' in (capabilities or [])
+            participant.compact = 'compact-encoding' in (capabilities or [])
+            if 'audience' in (capabilities or []) and 'audience' in room.capabilities:
+                self.join_audience(connection, room, participant)
+                return
+            try:
+                room.add_participant(participant)
+                self.joined(connection, room)
+                self.metrics.presence_frames += room.broadcast_status(participant, 'connected')
+                self.record('join', code, name=participant_name)
+                
+                response = JoinRoomResponseSuccess(room.creator.name,
+                        capabilities=room.capabilities, server_agent=self.server_agent)                
+                connection.sendMessage(response.encode())
+
+                for saved in self.broker_state.replay(code, participant_name):
+                    connection.sendMessage(saved)
+
+            except Exception as e:
+                log.warning('join-failed', room=code, name=participant_name, error=str(e))
+                connection.participant = None
+                response = JoinRoomResponseFailure(500, str(e), server_agent=self.server_agent)
+                connection.sendMessage(response.encode())
+                return
+
+        except Exception as e:
+            log.error('join-room-failed', peer=connection.peer, error=str(e))
+            response = JoinRoomResponseFailure(500, str(e), server_agent=self.server_agent)
+            connection.sendMessage(response.encode())
+
+    def join_audience(self, connection, room, member):
+        # No roster, presence or saved state: the audience only sees what is
+        # broadcast to the room from now on.
+        try:
+            room.add_audience(member)
+        except Exception as e:
+            log.warning('join-failed', room=room.code, name=member.name, error=str(e))
+            connection.participant = None
+            connection.sendMessage(JoinRoomResponseFailure(500, str(e), server_agent=self.server_agent).encode())
+            return
+        self.joined(connection, room)
+        connection.sendMessage(JoinRoomResponseSuccess(room.creator.name,
+                capabilities=room.capabilities, server_agent=self.server_agent).encode())
+
+    def audience_vote(self, room, member, data):
+        # Counted towards the Game's next tally instead of being relayed.
+        selection = data.get('selection', None)
+        answer = selection.get('answer-identifier', None) if isinstance(selection, dict) else None
+        if data['participant-name'] != room.creator.name or \
+                not room.vote(member, data.get('question-identifier', None), answer):
+            self.metrics.audience_ignored += 1
+            log.debug('audience-message-dropped', room=room.code, name=member.name)
+            return
+        self.metrics.audience_votes += 1
+        self.tally_later(room)
+
+    def tally_later(self, room):
+        # However many votes come in, the Game hears about them once a period.
+        if room.tally_flush is None:
+            room.tally_flush = self.clock.callLater(self.audience_tally_interval, self.flush_tallies, room)
+
+    def flush_tallies(self, room):
+        room.tally_flush = None
+        self.metrics.tally_frames += room.flush_tallies()
+
+    def participant_message(self, connection, data, payload=None):
+        try:
+            code = data['room-code']
+            if code not in self.rooms:
+                log.warning('no-such-room', peer=connection.peer, room=code)
+                return
+
+            room = self.rooms[code]
+
+            sender = self.participant_in(connection, room)
+            if sender is None:
+                log.warning('not-joined', peer=connection.peer, room=code)
+                return
+
+            if sender.audience:
+                self.audience_vote(room, sender, data)
+                return
+
+            name = data['participant-name']
+            recipient = room.participants.get(name, None)
+            # Kept for a participant who is not connected just now, to be
+            # replayed when they rejoin.
+            stored = 'broker-state' in data and 'broker-state' in room.capabilities
+            if recipient is None and not stored:
+                log.warning('no-such-participant', room=code, name=name)
+                return
+
+            if 'from' in data:
+                if sender.name != data['from']:
+                    log.warning('impersonation', room=code, sender=sender.name, claimed=data['from'])
+                    return
+            else:
+                data['from'] = sender.name
+                if payload is not None:
+                    payload = splice_from(payload, sender.name)
+
+            if payload is None:
+                payload = self.encode(data)
+            if stored:
+                self.broker_state.store(code, name, data['broker-state'], payload)
+                self.record('state', code, name=name, key=data['broker-state'],
+                        message=payload.decode('utf-8'))
+
+            if recipient is None:
+                log.debug('stored-for-absent', room=code, name=name)
+                return
+            kind, key = message_kind(data, sender)
+            recipient.connection.sendMessage(payload, kind=kind, key=key)
+            self.metrics.relayed_frames += 1
+            self.metrics.relayed_bytes += len(payload)
+
+        except Exception as e:
+            log.error('participant-message-failed', peer=connection.peer, error=str(e))
+
+    def broadcast_message(self, connection, data, payload=None):
+        try:
+            code = data['room-code']
+            if code not in self.rooms:
+                log.warning('no-such-room', peer=connection.peer, room=code)
+                return
+
+            room = self.rooms[code]
+
+            sender = self.participant_in(connection, room)
+            if sender is None:
+                log.warning('not-joined', peer=connection.peer, room=code)
+                return
+
+            if sender.audience:
+                log.warning('audience-broadcast', room=code, name=sender.name)
+                return
+
+            if 'from' in data:
+                if sender.name != data['from']:
+                    log.warning('impersonation', room=code, sender=sender.name, claimed=data['from'])
+                    return
+            else:
+                data['from'] = sender.name
+                if payload is not None:
+                    payload = splice_from(payload, sender.name)
+
+            # Encoded once, the same bytes go out on every socket in the room.
+            if payload is None:
+                payload = self.encode(data)
+            kind, key = message_kind(data, sender)
+            sent = room.broadcast(payload, sender, kind, key)
+            self.metrics.relayed_frames += sent
+            self.metrics.relayed_bytes += sent * len(payload)
+
+            if 'choices' in data and sender.name == room.creator.name and 'audience' in room.capabilities:
+                room.ask(data.get('question-identifier', None), data['choices'])
+
+        except Exception as e:
+            log.error('broadcast-message-failed', peer=connection.peer, error=str(e))
+
+
+Broker.commands = {
+    'create-room':  Broker.create_room,
+    'join-room': Broker.join_room,
+    'participant-message': Broker.participant_message,
+    'broadcast-message': Broker.broadcast_message,
+}
+
+# Rooms asking for the same capabilities share one tuple of them.
+capability_sets = {}
+
+def shared_capabilities(capabilities):
+    capabilities = tuple(sys.intern(cap) for cap in capabilities)
+    return capability_sets.setdefault(capabilities, capabilities)
+
+class Room:
+    __slots__ = ('code', 'creator', 'participants', 'expected', 'roster_frames', 'roster_batch',
+            'clock', 'roster_flush_window', 'pending_presence', 'presence_flush', 'reap_timer',
+            'capabilities', 'audience', 'votes', 'tally_flush')
+
+    # How many of the Game's questions the audience can vote on at once.
+    audience_questions = 16
+
+    def __init__(self, code, creator, capabilities=None, clock=None, roster_flush_window=0.05):
+        self.code = sys.intern(code)
+        self.creator = creator
+        self.participants = {}
+        # Names restored from the journal whose participants have not
+        # reconnected since the broker restarted.
+        self.expected = set()
+        # Cached roster made of each participant's pre-encoded "connected"
+        # status frame, and the same as a single participant-roster frame.
+        self.roster_frames = None
+        self.roster_batch = None
+        self.clock = clock
+        self.roster_flush_window = roster_flush_window
+        self.pending_presence = {}
+        self.presence_flush = None
+        self.reap_timer = None
+        self.capabilities = shared_capabilities(capabilities or ())
+        self.audience = {}
+        # Audience votes on the Game's recent questions, by question id.
+        self.votes = {}
+        self.tally_flush = None
+        if creator.connection is not None:
+            self.track(creator)
+
+    def track(self, participant):
+        self.participants[participant.name] = participant
+        # Built once on join and reused for every later roster.
+        participant.status_frame = codec.retain(self.encode_status(participant, 'connected'))
+        participant.roster_entry = codec.retain(ParticipantRosterEntry(participant.name, 'connected').encode())
+        self.expected.discard(participant.name)
+        self.membership_changed()
+        participant.room = self
+
+    def encode_status(self, participant, status):
+        return ParticipantStatusMessage(self.code, participant.name, status).encode()
+
+    def roster(self):
+        if self.roster_frames is None:
+            self.roster_frames = [ p.status_frame for p in self.participants.values() ]
+        return self.roster_frames
+
+    def roster_frame(self):
+        if self.roster_batch is None:
+            self.roster_batch = encode_roster(self.code,
+                    [ p.roster_entry for p in self.participants.values() ], True)
+        return self.roster_batch
+
+    def close(self):
+        if self.reap_timer is not None:
+            self.reap_timer.cancel()
+            self.reap_timer = None
+        if self.presence_flush is not None and self.presence_flush.active():
+            self.presence_flush.cancel()
+        self.presence_flush = None
+        if self.tally_flush is not None and self.tally_flush.active():
+            self.tally_flush.cancel()
+        self.tally_flush = None
+
+    def empty(self):
+        return not self.participants and not self.audience
+
+    def membership_changed(self):
+        self.roster_frames = None
+        self.roster_batch = None
+
+    def remove_participant(self, participant):
+        del self.participants[participant.name]
+        self.membership_changed()
+        log.debug('participant-left', room=self.code, name=participant.name)
+
+    def add_participant(self, participant):
+        if participant.name in self.participants or participant.name in self.audience:
+            log.info('duplicate-name', room=self.code, name=participant.name)
+            raise RuntimeError("Participant with that name is already connected.")
+
+        if participant.batched_roster:
+            participant.connection.sendMessage(self.roster_frame())
+        else:
+            for frame in self.roster():
+                participant.connection.sendMessage(frame)
+
+        self.track(participant)
+        log.debug('participant-joined', room=self.code, name=participant.name)
+
+    def broadcast(self, payload, sender=None, kind=None, key=None):
+        for obj in self.participants.values():
+            if obj is not sender:
+                obj.connection.sendMessage(payload, kind=kind, key=key)
+        for obj in self.audience.values():
+            obj.connection.sendMessage(payload, kind=kind, key=key)
+        return len(self.participants) + len(self.audience) - \
+                (sender is not None and sender.name in self.participants)
+
+    def broadcast_status(self, participant, status):
+        """Returns how many status frames went out on their own, rather
+        than batched into a roster later."""
+        if status == 'connected' and participant.status_frame is not None:
+            payload = participant.status_frame
+        else:
+            payload = self.encode_status(participant, status)
+
+        batched = False
+        sent = 0
+        for obj in self.participants.values():
+            if obj.batched_roster:
+                batched = True
+            elif obj is not participant:
+                obj.connection.sendMessage(payload, kind='presence')
+                sent += 1
+
+        if batched:
+            self.pending_presence[participant.name] = status
+            if self.presence_flush is None:
+                self.presence_flush = self.clock.callLater(self.roster_flush_window, self.flush_presence)
+        return sent
+
+    def flush_presence(self):
+        self.presence_flush = None
+        if not self.pending_presence:
+            return
+
+        entries = [ ParticipantRosterEntry(name, status).encode()
+                for name, status in self.pending_presence.items() ]
+        self.pending_presence = {}
+        payload = encode_roster(self.code, entries, False)
+
+        for obj in self.participants.values():
+            if obj.batched_roster:
+                obj.connection.sendMessage(payload, kind='presence')
+
+    def add_audience(self, member):
+        if member.name in self.participants or member.name in self.audience:
+            log.info('duplicate-name', room=self.code, name=member.name)
+            raise RuntimeError("Participant with that name is already connected.")
+        member.audience = True
+        self.audience[member.name] = member
+        member.room = self
+        log.debug('audience-joined', room=self.code, name=member.name)
+
+    def remove_audience(self, member):
+        """Returns whether the member had votes, which now need tallying."""
+        del self.audience[member.name]
+        log.debug('audience-left', room=self.code, name=member.name)
+        # Tallies count the audience there is, so their votes go with them.
+        withdrawn = False
+        for votes in self.votes.values():
+            withdrawn = votes.withdraw(member.name) or withdrawn
+        return withdrawn
+
+    def ask(self, question_id, choices):
+        # Asking the same question again keeps the votes it has.
+        if not isinstance(question_id, str) or question_id in self.votes:
+            return
+        answers = [ c.get('answer-identifier', None) for c in choices if isinstance(c, dict) ]
+        self.votes[question_id] = QuestionVotes(a for a in answers if isinstance(a, str))
+        if len(self.votes) > self.audience_questions:
+            del self.votes[next(iter(self.votes))]
+
+    def vote(self, member, question_id, answer):
+        """Counts member's vote, if it is for one of the answers to one of
+        the questions the Game asked."""
+        votes = self.votes.get(question_id, None) if isinstance(question_id, str) else None
+        if votes is None or not isinstance(answer, str) or answer not in votes.counts:
+            return False
+        votes.record(member.name, answer)
+        return True
+
+    def flush_tallies(self):
+        """Sends the Game a tally for each question with new votes, and
+        returns how many."""
+        # Looked up by name in case the Game has reconnected since.
+        game = self.participants.get(self.creator.name, None)
+        if game is None:
+            # Sent when the next vote comes in after the Game is back.
+            return 0
+        sent = 0
+        for question_id, votes in self.votes.items():
+            if votes.changed:
+                votes.changed = False
+                payload = AudienceTallyMessage(self.code, question_id, votes.counts, len(self.audience)).encode()
+                game.connection.sendMessage(payload, kind='tally', key=('tally', self.code, question_id))
+                sent += 1
+        return sent
+
+class QuestionVotes:
+    __slots__ = ('voters', 'counts', 'changed')
+
+    def __init__(self, answers):
+        # Each audience member's vote, and how many votes each answer has.
+        self.voters = {}
+        self.counts = dict.fromkeys(answers, 0)
+        self.changed = False
+
+    def record(self, name, answer):
+        previous = self.voters.get(name, None)
+        if previous == answer:
+            return
+        if previous is not None:
+            self.counts[previous] -= 1
+        self.voters[name] = answer
+        self.counts[answer] += 1
+        self.changed = True
+
+    def withdraw(self, name):
+        answer = self.voters.pop(name, None)
+        if answer is None:
+            return False
+        self.counts[answer] -= 1
+        self.changed = True
+        return True
+
+def encode_roster(code, entries, complete):
+    # Entries are already encoded JSON objects, so the frame is assembled
+    # by splicing bytes rather than re-encoding every participant.
+    return b''.join([
+        b'{"command":"participant-roster","room-code":',
+        codec.encode(code),
+        b',"complete":', b'true' if complete else b'false',
+        b',"participants":[', b','.join(entries), b']}'])
+
+def message_kind(data, sender):
+    # A question replaces whatever question its sender asked before, so a
+    # queued one that has not gone out yet can be dropped for the new one.
+    if 'choices' in data:
+        return 'question', ('question', sender.name)
+    return None, None
+
+def splice_from(payload, name):
+    # Relayed messages are forwarded as the bytes the sender wrote, with the
+    # "from" property inserted before the closing brace of the object, so
+    # the (opaque) body is never re-encoded.
+    end = payload.rfind(b'}')
+    return b''.join((payload[:end], b',"from":', codec.encode(name), payload[end:]))
+
+class Participant:
+    __slots__ = ('name', 'connection', 'room', 'batched_roster', 'compact', 'status_frame', 'roster_entry',
+            'audience')
+
+    def __init__(self, name, connection):
+        self.name = sys.intern(name)
+        self.connection = connection
+        if connection is not None:
+            connection.participant = self
+        self.room = None
+        self.batched_roster = False
+        self.compact = False
+        self.status_frame = None
+        self.roster_entry = None
+        self.audience = False
+
+def queue_report(broker, top):
+    """The /queues debug page: the deepest outbound queues, as JSON.  The
+    metrics only have totals; this says whose queue is backing up."""
+    try:
+        top = max(0, int(top))
+    except (TypeError, ValueError):
+        top = 100
+    return codec.encode({'connections': broker.queue_stats(top),
+        'closed-dropped': broker.metrics.closed_dropped})
+
+def error_location(msg, code=None, nick=None):
+    url = "/?message={}".format(quote_plus(msg))
+    if code:
+        url += "&code={}".format(quote_plus(code))
+    if nick:
+        url += "&nick={}".format(quote_plus(nick))
+    return url
+
+def join_location(broker, code, nick):
+    """Where the landing page's join form redirects to, as (status, url)."""
+    if code is None or not code:
+        log.debug('join-form-incomplete', missing='code')
+        return 302, error_location("No room code supplied!", code, nick)
+    code = code.strip()
+    if nick is None or not nick:
+        log.debug('join-form-incomplete', missing='nick')
+        return 302, error_location("No nickname supplied!", code, nick)
+    nick = nick.strip()
+
+    if not nick or not code:
+        log.debug('join-form-incomplete', missing='code or nick')
+        return 302, error_location("Nickname or room code were empty!", code, nick)
+
+    code = code.upper()
+    if len(nick) > 20:
+        nick = nick[:20]
+
+    if code not in broker.rooms and not broker.owns_room_code(code):
+        # Another worker owns this room, come back with the code in the
+        # URL so the master routes the request there.
+        return 307, "/join?code={}".format(quote_plus(code))
+
+    if code not in broker.rooms:
+        return 302, error_location("Room {} does not exist".format(code), code, nick)
+
+    #room_url = "/room#code:{code};nick:{nick}".format(code=code, nick=nick)
+    room_url = ('', '', '/room', '', 'code:{code};nick:{nick}'.format(code=quote_plus(code), nick=quote_plus(nick)))
+    url = urlunsplit(room_url)
+    log.debug('join-redirect', url=url)
+    return 302, url
@@ -0,0 +1,85 @@
+# Storage for the broker-state capability (capabilities/broker-state.rst).
+#
+# Messages are kept as the exact bytes that were relayed, keyed by room,
+# recipient and broker-state value, so replaying them on re-join is a
+# straight write to the socket.  Memory is capped per room and overall;
+# when a cap is exceeded the least recently used messages (stored or
+# replayed) are dropped.
+from collections import OrderedDict
+
+import codec
+
+# Rough per-entry bookkeeping cost on top of the message itself.
+ENTRY_OVERHEAD = 200
+
+def state_key(value):
+    if isinstance(value, (list, dict)):
+        return codec.retain(codec.encode(value))
+    return value
+
+class BrokerStateStore:
+    def __init__(self, room_limit=1024 * 1024, total_limit=64 * 1024 * 1024):
+        self.room_limit = room_limit
+        self.total_limit = total_limit
+        # (room, name) -> {key: (broker-state value, payload)}, for replay.
+        self.entries = {}
+        # Recency order per room and overall, with the size of each entry.
+        self.room_lru = {}
+        self.room_bytes = {}
+        self.lru = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+
+    def store(self, room, name, value, payload):
+        key = state_key(value)
+        self.discard(room, name, key)
+
+        size = len(payload) + ENTRY_OVERHEAD
+        self.entries.setdefault((room, name), {})[key] = (value, codec.retain(payload))
+        self.room_lru.setdefault(room, OrderedDict())[(name, key)] = size
+        self.room_bytes[room] = self.room_bytes.get(room, 0) + size
+        self.lru[(room, name, key)] = size
+        self.total_bytes += size
+
+        room_lru = self.room_lru[room]
+        while self.room_bytes[room] > self.room_limit and len(room_lru) > 1:
+            old_name, old_key = next(iter(room_lru))
+            self.discard(room, old_name, old_key)
+            self.evictions += 1
+        while self.total_bytes > self.total_limit and len(self.lru) > 1:
+            old_room, old_name, old_key = next(iter(self.lru))
+            self.discard(old_room, old_name, old_key)
+            self.evictions += 1
+
+    def discard(self, room, name, key):
+        size = self.lru.pop((room, name, key), None)
+        if size is None:
+            return
+        self.total_bytes -= size
+        self.room_bytes[room] -= size
+        del self.room_lru[room][(name, key)]
+        stored = self.entries[(room, name)]
+        del stored[key]
+        if not stored:
+            del self.entries[(room, name)]
+        if not self.room_lru[room]:
+            del self.room_lru[room]
+            del self.room_bytes[room]
+
+    def replay(self, room, name):
+        stored = self.entries.get((room, name), None)
+        if stored is None:
+            return []
+        room_lru = self.room_lru[room]
+        for key in stored:
+            room_lru.move_to_end((name, key))
+            self.lru.move_to_end((room, name, key))
+        return [ payload for value, payload in stored.values() ]
+
+    def drop_room(self, room):
+        for name, key in list(self.room_lru.get(room, ())):
+            self.discard(room, name, key)
+
+    def saved_state(self, room):
+        return [ [name, self.entries[(room, name)][key][0], self.entries[(room, name)][key][1].decode('utf-8')]
+                for name, key in self.room_lru.get(room, ()) ]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# requires aiohttp (for the websocket that creates the rooms)
+#
+# Checks that the join form reaches the room on a sharded broker.  Starts
+# broker.py with two workers, creates a few rooms, then posts the join form
+# for each of them over one keep-alive HTTP connection, following 307s
+# the way a browser does.  The master routes a connection by its first
+# request only, so a join that lands on the wrong worker has to be sent
+# back through the master on a new connection; if it is not, the retry
+# gets another 307 and this never reaches the room.
+import argparse
+import asyncio
+import http.client
+import json
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+
+ROOMS = 4
+JOINS = 5
+MAX_HOPS = 4
+
+async def create_rooms(port, count):
+    session = aiohttp.ClientSession()
+    sockets = []
+    codes = []
+    for i in range(count):
+        ws = await session.ws_connect('http://127.0.0.1:{}/ws'.format(port))
+        await ws.send_str(json.dumps({'command': 'create-room', 'capabilities': ['multi-choice']}))
+        codes.append(json.loads((await ws.receive()).data)['room-code'])
+        sockets.append(ws)
+    return session, codes
+
+def join(conn, code, nick):
+    """Posts the join form, following redirects, and returns the final
+    response and how many 307s it took."""
+    path = '/join'
+    body = urlencode({'code': code, 'nick': nick})
+    for hops in range(MAX_HOPS):
+        conn.request('POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        response = conn.getresponse()
+        response.read()
+        if response.status != 307:
+            return response, hops
+        path = response.getheader('Location')
+    return response, MAX_HOPS
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end check of joining rooms on a sharded broker")
+    parser.add_argument('--port', type=int, default=9050)
+    args = parser.parse_args()
+
+    broker = subprocess.Popen([sys.executable, 'broker.py', '--port', str(args.port), '--workers', '2'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    loop = asyncio.new_event_loop()
+    try:
+        time.sleep(3)
+        session, codes = loop.run_until_complete(create_rooms(args.port, ROOMS))
+        conn = http.client.HTTPConnection('127.0.0.1', args.port)
+        failed = 0
+        redirects = 0
+        for i in range(JOINS):
+            for code in codes:
+                response, hops = join(conn, code, "Player{}".format(i))
+                redirects += hops
+                location = response.getheader('Location') or ''
+                if response.status != 302 or not location.startswith('/room'):
+                    print("Join of {} ended with {} {}".format(code, response.status, location))
+                    failed += 1
+        loop.run_until_complete(session.close())
+        print("{} joins, {} failed, {} redirects to another worker".format(
+            JOINS * len(codes), failed, redirects))
+        return 1 if failed else 0
+    finally:
+        loop.close()
+        broker.terminate()
+        broker.wait()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+# JSON encoding shared by the broker, the games and messages.py.
+#
+# Messages go over the websocket as UTF-8 bytes, so encode() returns bytes
+# and decode() takes bytes, without an intermediate str where the backend
+# allows it.  orjson or ujson are used when installed, otherwise the
+# standard library json module.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def stdlib_encode(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def stdlib_decode(payload):
+    # json.loads detects UTF-8 bytes itself.
+    return json.loads(payload)
+
+def ujson_encode(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def ujson_decode(payload):
+    return ujson.loads(payload)
+
+def orjson_encode(obj):
+    return orjson.dumps(obj)
+
+def orjson_decode(payload):
+    return orjson.loads(payload)
+
+backends = {'json': (stdlib_encode, stdlib_decode)}
+if ujson is not None:
+    backends['ujson'] = (ujson_encode, ujson_decode)
+if orjson is not None:
+    backends['orjson'] = (orjson_encode, orjson_decode)
+
+def retain(payload):
+    # orjson's output keeps its whole encode buffer (a KiB or more) however
+    # short the message, so frames the broker holds on to are copied down
+    # to size first.
+    if backend == 'orjson':
+        return bytes(memoryview(payload))
+    return payload
+
+def use(name):
+    global backend, encode, decode
+    if name not in backends:
+        raise ValueError("JSON backend {} is not available".format(name))
+    backend = name
+    encode, decode = backends[name]
+
+if orjson is not None:
+    use('orjson')
+elif ujson is not None:
+    use('ujson')
+else:
+    use('json')
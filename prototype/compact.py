@@ -0,0 +1,74 @@
+# The compact-encoding capability (capabilities/compact-encoding.rst):
+# messages as MessagePack with the protocol's property names and commands
+# replaced by small integers.
+#
+# Games and Clients always reach the broker code as the same dicts and
+# JSON bytes as before; frames are only translated on the way in from and
+# out to connections that asked for the compact encoding.
+import codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The position in each list is the id on the wire; only ever append.
+FIELDS = [
+    'command', 'room-code', 'participant-name', 'capabilities', 'user-agent',
+    'server-agent', 'creator', 'creator-agent', 'status', 'status-message',
+    'presence', 'from', 'broker-state', 'question-identifier', 'prompt',
+    'choices', 'answer-identifier', 'label', 'selection', 'static-message',
+    'html-text-content', 'complete', 'participants', 'static-message-append',
+    'tallies', 'count', 'audience',
+]
+COMMANDS = [
+    'create-room', 'create-room-response', 'join-room', 'join-room-response',
+    'participant-message', 'broadcast-message', 'participant-status',
+    'participant-roster', 'audience-tally',
+]
+
+FIELD_IDS = { name: i for i, name in enumerate(FIELDS) }
+COMMAND_IDS = { name: i for i, name in enumerate(COMMANDS) }
+
+def shorten(obj):
+    if isinstance(obj, dict):
+        return { FIELD_IDS.get(k, k): shorten(v) for k, v in obj.items() }
+    if isinstance(obj, list):
+        return [ shorten(v) for v in obj ]
+    return obj
+
+def lengthen(obj):
+    if isinstance(obj, dict):
+        return { FIELDS[k] if isinstance(k, int) else k: lengthen(v) for k, v in obj.items() }
+    if isinstance(obj, list):
+        return [ lengthen(v) for v in obj ]
+    return obj
+
+def encode(data):
+    msg = shorten(data)
+    if data.get('command', None) in COMMAND_IDS:
+        msg[0] = COMMAND_IDS[data['command']]
+    return msgpack.packb(msg)
+
+def decode(payload):
+    data = lengthen(msgpack.unpackb(payload, strict_map_key=False))
+    if isinstance(data.get('command', None), int):
+        data['command'] = COMMANDS[data['command']]
+    return data
+
+# The last frames translated, by identity: a broadcast hands the same JSON
+# bytes to every connection in the room, so it is translated once however
+# many of them use the compact encoding.  The JSON is kept alongside so its
+# id cannot be reused while it is in here.
+CACHE_SIZE = 64
+translated = {}
+
+def translate(payload):
+    entry = translated.get(id(payload), None)
+    if entry is not None and entry[0] is payload:
+        return entry[1]
+    frame = encode(codec.decode(payload))
+    if len(translated) >= CACHE_SIZE:
+        del translated[next(iter(translated))]
+    translated[id(payload)] = (payload, frame)
+    return frame
@@ -0,0 +1,147 @@
+# Structured, rate-limited logging for the broker.
+#
+# Log calls name an event and give its details as keyword arguments:
+#
+#     log.info('room-created', room=code, creator=name)
+#
+# Records go on a queue and are formatted and written by a background
+# thread, so the reactor never waits on stdout.  A disabled level's method
+# is swapped for a no-op, so a debug call on the hot path costs the call
+# and nothing else.  Each event is rate limited on its own, and the first
+# record written after some were dropped says how many.
+#
+# Records from the standard logging module (aiohttp's, for instance) go
+# through the same queue.
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+loggers = {}
+listener = None
+
+def noop(event, **fields):
+    pass
+
+class EventLogger:
+    def __init__(self, name, rate=20, burst=100):
+        self.name = name
+        self.logger = logging.getLogger(name)
+        self.rate = rate
+        self.burst = burst
+        # event -> [tokens, last refill, records dropped since last written]
+        self.buckets = {}
+        self.refresh()
+
+    def refresh(self):
+        for name, level in LEVELS.items():
+            if self.logger.isEnabledFor(level):
+                setattr(self, name, self.emitter(level))
+            else:
+                setattr(self, name, noop)
+
+    def emitter(self, level):
+        def emit(event, **fields):
+            self.log(level, event, fields)
+        return emit
+
+    def log(self, level, event, fields):
+        now = time.monotonic()
+        bucket = self.buckets.get(event, None)
+        if bucket is None:
+            bucket = self.buckets[event] = [self.burst, now, 0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return
+        bucket[0] -= 1
+        if bucket[2]:
+            fields['suppressed'] = bucket[2]
+            bucket[2] = 0
+        record = self.logger.makeRecord(self.name, level, self.name, 0, event, None, None,
+                extra={'fields': fields})
+        self.logger.handle(record)
+
+def get(name):
+    if name not in loggers:
+        loggers[name] = EventLogger(name)
+    return loggers[name]
+
+class QueueHandler(logging.Handler):
+    # logging.handlers.QueueHandler formats records before queueing them,
+    # which is the work this is meant to keep off the reactor thread.
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        self.records.put_nowait(record)
+
+def format_value(value):
+    if isinstance(value, str) and value and not any(c in value for c in ' "=\n'):
+        return value
+    return json.dumps(value, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = "{} {:<7} {} {}".format(self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                record.levelname, record.name, record.getMessage())
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += " " + " ".join("{}={}".format(k, format_value(v)) for k, v in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname.lower(),
+                'logger': record.name, 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+FORMATS = {'text': TextFormatter, 'json': JSONFormatter}
+
+def setup(level='info', format='text', stream=None):
+    """Starts the writer thread and sends every log record to it."""
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(FORMATS[format]())
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, writer)
+    listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(LEVELS[level])
+    for logger in loggers.values():
+        logger.refresh()
+
+def shutdown():
+    """Writes out whatever is still queued and stops the writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def add_arguments(parser):
+    parser.add_argument('--log-level', choices=list(LEVELS), default='info')
+    parser.add_argument('--log-format', choices=list(FORMATS), default='text')
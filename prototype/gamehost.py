@@ -0,0 +1,91 @@
+# Runs many games in one process over a few connections to the broker.
+#
+# A game is an object the host gives a connection (to send with) and a
+# clock (for callLater), with a capabilities list, create_room() to send
+# its create-room command, and handle(data) for each message about its
+# room.  Games are spread over the connections in turn; when a connection
+# carries more than one they ask for the multi-room capability
+# (capabilities/multi-room.rst), and the host hands each message from the
+# broker to the game whose room-code it has, decoding it once.
+#
+# The games' timers all go on one timer wheel rather than each being a
+# separate delayed call on the reactor.
+import collections
+
+from twisted.internet.endpoints import clientFromString
+from autobahn.twisted.websocket import WebSocketClientFactory
+from autobahn.twisted.websocket import WebSocketClientProtocol
+
+import codec
+import timerwheel
+
+class HostConnection(WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.host.connected(self)
+
+    def onMessage(self, payload, isBinary):
+        self.factory.host.dispatch(self, payload, isBinary)
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.host.disconnected(self, reason)
+
+class HostFactory(WebSocketClientFactory):
+    protocol = HostConnection
+
+class GameHost:
+    def __init__(self, games, connections=1, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.timers = timerwheel.TimerWheel(clock)
+        # The games for each connection yet to open.
+        self.unplaced = [ list(games[i::connections]) for i in range(connections) ]
+        # By connection, the games waiting for their create-room-response,
+        # which the broker sends in the order the rooms were asked for.
+        self.creating = {}
+        # By room code.
+        self.games = {}
+
+    def connect(self, endpoint, wsurl):
+        self.timers.start()
+        factory = HostFactory(wsurl)
+        factory.host = self
+        client = clientFromString(self.clock, endpoint)
+        for i in range(len(self.unplaced)):
+            client.connect(factory)
+
+    def connected(self, connection):
+        games = self.unplaced.pop() if self.unplaced else []
+        print("Connection to broker established for {} games".format(len(games)))
+        self.creating[connection] = collections.deque(games)
+        for game in games:
+            game.connection = connection
+            game.clock = self.timers
+            if len(games) > 1 and 'multi-room' not in game.capabilities:
+                game.capabilities.append('multi-room')
+            game.create_room()
+
+    def dispatch(self, connection, payload, isBinary):
+        if isBinary:
+            return
+
+        data = codec.decode(payload)
+        if data.get('command', None) == 'create-room-response':
+            game = self.creating[connection].popleft()
+            if data['status'] == 0:
+                self.games[data['room-code']] = game
+            game.handle(data)
+            return
+
+        game = self.games.get(data.get('room-code', None), None)
+        if game is None:
+            print("Message for a room with no game: {}".format(payload))
+            return
+        game.handle(data)
+
+    def disconnected(self, connection, reason):
+        lost = [ code for code, game in self.games.items() if game.connection is connection ]
+        for code in lost:
+            del self.games[code]
+        self.creating.pop(connection, None)
+        print("Connection to broker lost ({}), {} rooms closed".format(reason, len(lost)))
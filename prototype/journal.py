@@ -0,0 +1,143 @@
+# Room state persistence for the broker.
+#
+# Changes are appended to a journal file as one encoded record per line.
+# Records are buffered and written behind, in one write per flush, so
+# recording a change on the hot path is a list append.  Every so often the
+# whole state is written to a compact snapshot and the journal is started
+# over, so a restart loads one snapshot plus a short journal tail instead of
+# replaying every change since the broker was first started.
+#
+# The state kept is a plain dict, room code -> {"creator", "capabilities",
+# "participants", "state"}, which the broker turns back into rooms on
+# restart; "state" holds the stored broker-state messages.
+import os
+
+import codec
+
+class Journal:
+    def __init__(self, directory, clock, flush_interval=0.1, snapshot_interval=60,
+            snapshot_records=100000, fsync=False):
+        self.directory = directory
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_records = snapshot_records
+        self.fsync = fsync
+        self.journal_path = os.path.join(directory, 'journal')
+        self.snapshot_path = os.path.join(directory, 'snapshot')
+        self.state_provider = None
+        self.buffer = []
+        self.flush_call = None
+        self.snapshot_call = None
+        self.records_since_snapshot = 0
+        self.seq = 0
+        self.log = None
+
+    def load(self):
+        """Returns the saved state, and opens the journal for appending."""
+        os.makedirs(self.directory, exist_ok=True)
+        state = {}
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = codec.decode(f.read())
+            snapshot_seq = snapshot['seq']
+            for room in snapshot['rooms']:
+                state[room['code']] = room
+            self.seq = snapshot_seq
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = codec.decode(line)
+                    except ValueError:
+                        # A torn final write from a crash, nothing follows it.
+                        break
+                    if record['seq'] <= snapshot_seq:
+                        continue
+                    apply_record(state, record)
+                    self.seq = record['seq']
+                    self.records_since_snapshot += 1
+
+        self.log = open(self.journal_path, 'ab')
+        self.snapshot_call = self.clock.callLater(self.snapshot_interval, self.snapshot)
+        return state
+
+    def record(self, op, room, **fields):
+        self.seq += 1
+        fields['seq'] = self.seq
+        fields['op'] = op
+        fields['room'] = room
+        self.buffer.append(codec.encode(fields))
+        self.records_since_snapshot += 1
+        if self.flush_call is None:
+            self.flush_call = self.clock.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_call = None
+        if not self.buffer:
+            return
+        self.buffer.append(b'')
+        self.log.write(b'\n'.join(self.buffer))
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+        self.buffer = []
+        if self.records_since_snapshot >= self.snapshot_records:
+            self.snapshot()
+
+    def snapshot(self):
+        if self.snapshot_call is not None and self.snapshot_call.active():
+            self.snapshot_call.cancel()
+        self.snapshot_call = self.clock.callLater(self.snapshot_interval, self.snapshot)
+        if self.state_provider is None:
+            return
+
+        # Everything buffered is already reflected in the live state, and
+        # so in the snapshot; the journal restarts after it.
+        self.buffer = []
+        snapshot = {'seq': self.seq, 'rooms': list(self.state_provider().values())}
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(codec.encode(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.log.close()
+        self.log = open(self.journal_path, 'wb')
+        self.records_since_snapshot = 0
+
+    def close(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush()
+        if self.snapshot_call is not None and self.snapshot_call.active():
+            self.snapshot_call.cancel()
+        self.log.close()
+
+def apply_record(state, record):
+    op = record['op']
+    code = record['room']
+    if op == 'create':
+        state[code] = {'code': code, 'creator': record['creator'],
+                'capabilities': record['capabilities'], 'participants': [], 'state': []}
+    elif op == 'remove':
+        state.pop(code, None)
+    elif code in state:
+        room = state[code]
+        if op == 'join':
+            if record['name'] not in room['participants']:
+                room['participants'].append(record['name'])
+        elif op == 'leave':
+            if record['name'] in room['participants']:
+                room['participants'].remove(record['name'])
+        elif op == 'state':
+            # Same overwrite rule as the live store: the latest message for
+            # a name and broker-state value wins.
+            stored = room.setdefault('state', [])
+            for entry in stored:
+                if entry[0] == record['name'] and entry[1] == record['key']:
+                    stored.remove(entry)
+                    break
+            stored.append([record['name'], record['key'], record['message']])
@@ -1,9 +1,11 @@
-import json
+import codec
 
 import random
 alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
 
 class CreateRoomMessage:
+    __slots__ = ('capabilities', 'user_agent', 'name')
+
     def __init__(self, capabilities, user_agent=None, name=None):
         self.capabilities = capabilities
         self.user_agent = user_agent
@@ -17,9 +19,11 @@ class CreateRoomMessage:
         if self.name is not None:
             msg['participant-name'] = self.name
 
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
 
 class CreateRoomResponseSuccess:
+    __slots__ = ('room_code', 'capabilities', 'server_agent')
+
     def __init__(self, room_code, capabilities, server_agent=None):
         self.room_code = room_code
         self.capabilities = capabilities
@@ -34,9 +38,11 @@ class CreateRoomResponseSuccess:
         msg['status'] = 0
         msg['status-message'] = "Room {} created successfully".format(self.room_code)
 
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
 
 class CreateRoomResponseFailure:
+    __slots__ = ('status', 'msg', 'capabilities', 'server_agent')
+
     def __init__(self, status, msg, capabilities, server_agent=None):
         self.status = status
         self.msg = msg
@@ -51,9 +57,11 @@ class CreateRoomResponseFailure:
         msg['status'] = self.status
         msg['status-message'] = self.msg
 
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
 
 class JoinRoomMessage:
+    __slots__ = ('room_code', 'name', 'capabilities', 'user_agent')
+
     def __init__(self, room_code, name, user_agent=None, capabilities=None):
         self.room_code = room_code
         self.name = name
@@ -69,9 +77,11 @@ class JoinRoomMessage:
         if self.user_agent is not None:
             msg['user-agent'] = self.user_agent
 
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
 
 class JoinRoomResponseSuccess:
+    __slots__ = ('creator', 'capabilities', 'creator_agent', 'server_agent')
+
     def __init__(self, creator, capabilities=None, creator_agent=None, server_agent=None):
         self.creator = creator
         self.capabilities = capabilities
@@ -90,9 +100,11 @@ class JoinRoomResponseSuccess:
         msg['status'] = 0
         msg['status-message'] = "Joined"
 
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
     
 class JoinRoomResponseFailure:
+    __slots__ = ('status', 'msg', 'creator', 'capabilities', 'creator_agent', 'server_agent')
+
     def __init__(self, status, msg, creator=None, capabilities=None, creator_agent=None, server_agent=None):
         self.status = status
         self.msg = msg
@@ -116,9 +128,11 @@ class JoinRoomResponseFailure:
         msg['status'] = self.status
         msg['status-message'] = self.msg
 
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
 
 class ParticipantStatusMessage:
+    __slots__ = ('room', 'name', 'status')
+
     def __init__(self, room, name, status):
         self.room = room
         self.name = name
@@ -126,13 +140,47 @@ class ParticipantStatusMessage:
 
 
     def encode(self):
-        msg = {"command": "join-room-response"}
+        msg = {"command": "participant-status"}
         msg['room-code'] = self.room
         msg['participant-name'] = self.name
         msg['presence'] = self.status
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
+
+class ParticipantRosterEntry:
+    __slots__ = ('name', 'status')
+
+    def __init__(self, name, status):
+        self.name = name
+        self.status = status
+
+    def encode(self):
+        msg = {'participant-name': self.name}
+        msg['presence'] = self.status
+        return codec.encode(msg)
 
+class AudienceTallyMessage:
+    __slots__ = ('room', 'question_id', 'counts', 'audience')
+
+    def __init__(self, room, question_id, counts, audience):
+        self.room = room
+        self.question_id = question_id
+        self.counts = counts
+        self.audience = audience
+
+    def encode(self):
+        msg = {"command": "audience-tally"}
+        msg['room-code'] = self.room
+        msg['question-identifier'] = self.question_id
+        msg['tallies'] = [ {'answer-identifier': answer, 'count': count}
+                for answer, count in self.counts.items() ]
+        msg['audience'] = self.audience
+        return codec.encode(msg)
+
+# For SimpleMultiChoiceQuestion and StaticMessage a participant of None
+# encodes a broadcast-message to the whole room instead.
 class SimpleMultiChoiceQuestion:
+    __slots__ = ('room', 'participant', 'prompt', 'choices', 'question_id')
+
     def __init__(self, room, participant, prompt, choices):
         self.room = room
         self.participant = participant
@@ -148,15 +196,21 @@ class SimpleMultiChoiceQuestion:
         return r
 
     def encode(self):
-        msg = {"command": "participant-message"}
+        if self.participant is None:
+            msg = {"command": "broadcast-message"}
+        else:
+            msg = {"command": "participant-message"}
         msg['question-identifier'] = self.question_id
         msg['prompt'] = self.prompt
         msg['choices'] = self.choices
         msg['room-code'] = self.room
-        msg['participant-name'] = self.participant
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        if self.participant is not None:
+            msg['participant-name'] = self.participant
+        return codec.encode(msg)
 
 class SimpleMultiChoiceAnswer:
+    __slots__ = ('room', 'participant', 'question_id', 'choice')
+
     def __init__(self, room, participant, qid, choice):
         self.room = room
         self.participant = participant
@@ -169,20 +223,30 @@ class SimpleMultiChoiceAnswer:
         msg['selection'] = self.choice
         msg['room-code'] = self.room
         msg['participant-name'] = self.participant
-        return json.dumps(msg, ensure_ascii=False).encode('utf-8')
+        return codec.encode(msg)
 
 class StaticMessage:
-    def __init__(self, room, participant, msg, is_html=False):
+    __slots__ = ('room', 'participant', 'msg', 'is_html', 'append')
+
+    def __init__(self, room, participant, msg, is_html=False, append=False):
         self.room = room
         self.participant = participant
         self.msg = msg
         self.is_html = is_html
+        # Shown below what the client already shows rather than replacing it.
+        self.append = append
 
     def encode(self):
-        msg = {"command":"participant-message"}
+        if self.participant is None:
+            msg = {"command": "broadcast-message"}
+        else:
+            msg = {"command": "participant-message"}
         msg['room-code'] = self.room
-        msg['participant-name'] = self.participant
+        if self.participant is not None:
+            msg['participant-name'] = self.participant
         msg['static-message'] = self.msg
         if self.is_html:
             msg['html-text-content'] = [ 'static-message' ]
-        return json.dumps(msg, ensure_ascii=False).encode("utf-8")
+        if self.append:
+            msg['static-message-append'] = True
+        return codec.encode(msg)
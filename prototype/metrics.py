@@ -0,0 +1,261 @@
+# Counters and histograms for the broker, served on /metrics in the
+# Prometheus text format.
+#
+# Everything that records a metric runs on the reactor (or event loop)
+# thread, so the hot path updates plain attributes with no locks; a
+# sharded broker has one set per worker process.  Unlabelled counters are
+# plain ints on BrokerMetrics, read when scraped; callers look up the
+# labelled child they need once and keep it.  Recording is an integer
+# increment for a counter and a bisect for a histogram.
+#
+# Relayed frames and bytes are counted once per message (a broadcast adds
+# its recipients times its size) rather than once per frame sent.
+# Whatever can be read off the broker's state instead is, when scraped:
+# rooms, participants, queue depth and frames dropped from the queues.
+import itertools
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a few microseconds (a decode) to a slow relay.
+TIME_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+        0.005, 0.01, 0.025, 0.05, 0.1)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values)) + "}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One more than the bounds, for the +Inf bucket.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Family:
+    """A metric and its labelled children.  Given read, a function
+    returning (label values, value) pairs, the values are read from that
+    when scraped instead."""
+    kind = None
+
+    def __init__(self, name, help, labels=(), read=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.children = {}
+        self.read = read
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values, None)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} {}".format(self.name, self.kind)]
+
+    def render(self):
+        if self.read is not None:
+            samples = self.read()
+        else:
+            samples = [ (values, child.value) for values, child in self.children.items() ]
+        lines = self.header()
+        for values, value in samples:
+            lines.append("{}{} {}".format(self.name, format_labels(self.labelnames, values),
+                format_value(value)))
+        return lines
+
+class Counter(Family):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+class Gauge(Family):
+    kind = 'gauge'
+
+class Histogram(Family):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        Family.__init__(self, name, help, labels)
+        self.bounds = tuple(buckets)
+
+    def new_child(self):
+        return HistogramChild(self.bounds)
+
+    def render(self):
+        lines = self.header()
+        names = self.labelnames + ('le',)
+        for values, child in self.children.items():
+            total = 0
+            for bound, count in zip(self.bounds + (float('inf'),), child.counts):
+                total += count
+                lines.append("{}_bucket{} {}".format(self.name,
+                    format_labels(names, values + (format_value(bound),)), total))
+            labels = format_labels(self.labelnames, values)
+            lines.append("{}_sum{} {}".format(self.name, labels, format_value(child.sum)))
+            lines.append("{}_count{} {}".format(self.name, labels, total))
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.families = []
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        lines.append("")
+        return "\n".join(lines).encode('utf-8')
+
+class BrokerMetrics:
+    # Anything else sent by a client is counted under this, so a client
+    # cannot add labels.
+    OTHER = 'other'
+
+    def __init__(self, broker, sample_every=16):
+        self.broker = broker
+        # One message in every sample_every is timed for the decode and
+        # command histograms; the counters count every message.
+        self.sample_every = sample_every
+        self.registry = registry = Registry()
+
+        self.messages = registry.add(Counter('broker_messages_total',
+            "Commands received, by command.", ['command']))
+        self.rejected = registry.add(Counter('broker_messages_rejected_total',
+            "Commands that failed schema validation, by command.", ['command']))
+        # Counted in plain ints, the cheapest thing to bump once a frame.
+        self.bad_frames = 0
+        self.presence_frames = 0
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.relayed_frames = 0
+        self.relayed_bytes = 0
+        self.audience_votes = 0
+        self.audience_ignored = 0
+        self.tally_frames = 0
+        # Frames dropped by the outbound queues of connections now closed.
+        self.closed_dropped = 0
+        self.total('broker_bad_frames_total', "Frames that could not be decoded or had no command.",
+                'bad_frames')
+        self.command_seconds = registry.add(Histogram('broker_command_seconds',
+            "Time from a command being decoded to its frames being queued to send, "
+            "validation included; the relay latency for participant-message and "
+            "broadcast-message.  Sampled.", ['command']))
+        self.decode_seconds = registry.add(Histogram('broker_decode_seconds',
+            "Time to decode an incoming frame, by encoding.  Sampled.", ['encoding']))
+        self.encode_seconds = registry.add(Histogram('broker_encode_seconds',
+            "Time to encode an outgoing frame, by encoding.", ['encoding']))
+        self.total('broker_presence_frames_total',
+                "Participant status frames sent on their own (not batched into a roster).",
+                'presence_frames')
+        self.total('broker_received_frames_total', "Websocket messages received.",
+                'received_frames')
+        self.total('broker_received_bytes_total', "Bytes of websocket message payload received.",
+                'received_bytes')
+        self.total('broker_relayed_frames_total',
+                "Participant and broadcast messages relayed, one per recipient.", 'relayed_frames')
+        self.total('broker_relayed_bytes_total',
+                "Bytes of participant and broadcast messages relayed, as JSON.", 'relayed_bytes')
+        self.total('broker_audience_votes_total', "Audience votes counted into tallies.",
+                'audience_votes')
+        self.total('broker_audience_dropped_total',
+                "Audience messages dropped for not being a vote on an open question.",
+                'audience_ignored')
+        self.total('broker_audience_tally_frames_total', "Audience tallies sent to Games.",
+                'tally_frames')
+        registry.add(Counter('broker_send_queue_dropped_total',
+            "Frames dropped from outbound queues rather than sent.",
+            read=lambda: [((), self.closed_dropped + sum(queue.dropped for queue in self.queues()))]))
+
+        registry.add(Gauge('broker_rooms', "Rooms open.",
+            read=lambda: [((), len(broker.rooms))]))
+        registry.add(Gauge('broker_participants', "Participants connected.",
+            read=lambda: [((), sum(len(room.participants) for room in broker.rooms.values()))]))
+        registry.add(Gauge('broker_audience', "Audience members connected.",
+            read=lambda: [((), sum(len(room.audience) for room in broker.rooms.values()))]))
+        self.room_sizes = registry.add(Histogram('broker_room_participants',
+            "Participants connected per room, as of the scrape.", buckets=SIZE_BUCKETS))
+        registry.add(Gauge('broker_send_queue_frames',
+            "Frames waiting in outbound queues: in total, and in the deepest one.",
+            ['queue'], read=self.queue_depths))
+        registry.add(Gauge('broker_send_queue_bytes', "Bytes waiting in outbound queues.",
+            read=lambda: [((), sum(queue.bytes for queue in self.queues()))]))
+
+        self.commands = {}
+        for command in list(broker.commands) + [self.OTHER]:
+            self.commands[command] = (self.messages.labels(command),
+                    self.command_seconds.labels(command))
+        self.decode_json = self.decode_seconds.labels('json')
+        self.decode_compact = self.decode_seconds.labels('compact')
+        self.encode_json = self.encode_seconds.labels('json')
+        self.encode_compact = self.encode_seconds.labels('compact')
+
+    def total(self, name, help, attribute):
+        self.registry.add(Counter(name, help, read=lambda: [((), getattr(self, attribute))]))
+
+    def closed_queue(self, queue):
+        self.closed_dropped += queue.dropped
+
+    def command(self, command):
+        """The (count, time) pair to record a command under."""
+        return self.commands.get(command, None) or self.commands[self.OTHER]
+
+    def reject(self, command):
+        if command not in self.commands:
+            command = self.OTHER
+        self.rejected.labels(command).inc()
+
+    def queues(self):
+        # A connection hosting several rooms is in each of them.
+        seen = set()
+        for room in self.broker.rooms.values():
+            for participant in itertools.chain(room.participants.values(), room.audience.values()):
+                queue = getattr(participant.connection, 'outbound', None)
+                if queue is not None and id(queue) not in seen:
+                    seen.add(id(queue))
+                    yield queue
+
+    def queue_depths(self):
+        depths = [ queue.depth for queue in self.queues() ]
+        return [(('total',), sum(depths)), (('deepest',), max(depths, default=0))]
+
+    def render(self):
+        # Room sizes are a snapshot, so the histogram starts over each time.
+        self.room_sizes.children.clear()
+        sizes = self.room_sizes.labels()
+        for room in self.broker.rooms.values():
+            sizes.observe(len(room.participants))
+        return self.registry.render()
@@ -0,0 +1,135 @@
+# Bounded outbound queue for a broker connection.
+#
+# The connection registers itself as a push producer on its transport, so
+# Twisted tells it when the socket's write buffer is full (pauseProducing)
+# and when it has drained (resumeProducing).  While paused, frames are held
+# here instead of piling up in the transport, and what happens when the
+# queue fills up depends on the frame:
+#
+#   presence  participant-status frames; the oldest queued one is dropped.
+#   question  a question superseded by a newer one from the same sender is
+#             dropped in favour of the new one.
+#   others    the queue's overflow policy: 'disconnect' (the default) drops
+#             the connection, 'drop-oldest' drops the oldest queued frame.
+import socket
+from collections import deque
+
+class OutboundQueue:
+    def __init__(self, write, disconnect, max_frames=256, max_bytes=1024 * 1024, overflow='disconnect'):
+        if overflow not in ('disconnect', 'drop-oldest'):
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        self.write = write
+        self.disconnect = disconnect
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.paused = False
+        self.closed = False
+        # Entries are [payload, isBinary, kind, key]; a dropped entry has its
+        # payload set to None and is skipped when the queue drains.
+        self.queue = deque()
+        self.presence = deque()
+        self.superseded = {}
+        self.depth = 0
+        self.bytes = 0
+        self.max_depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def send(self, payload, isBinary=False, kind=None, key=None):
+        if self.closed:
+            return
+        if not self.paused and not self.depth:
+            self.write(payload, isBinary)
+            return
+
+        entry = [payload, isBinary, kind, key]
+        if key is not None:
+            previous = self.superseded.get(key, None)
+            if previous is not None and previous[0] is not None:
+                self.drop(previous)
+                self.coalesced += 1
+            self.superseded[key] = entry
+        if kind == 'presence':
+            self.presence.append(entry)
+        self.queue.append(entry)
+        self.depth += 1
+        self.bytes += len(payload)
+        self.max_depth = max(self.max_depth, self.depth)
+
+        while self.depth > self.max_frames or self.bytes > self.max_bytes:
+            if not self.drop_oldest_presence() and not self.handle_overflow():
+                return
+
+    def drop(self, entry):
+        self.depth -= 1
+        self.bytes -= len(entry[0])
+        entry[0] = None
+
+    def drop_oldest_presence(self):
+        while self.presence:
+            entry = self.presence.popleft()
+            if entry[0] is not None:
+                self.drop(entry)
+                self.dropped += 1
+                return True
+        return False
+
+    def handle_overflow(self):
+        if self.overflow == 'drop-oldest':
+            while self.queue:
+                entry = self.queue.popleft()
+                if entry[0] is not None:
+                    self.drop(entry)
+                    self.dropped += 1
+                    return True
+            return False
+
+        self.dropped += self.depth
+        self.clear()
+        self.closed = True
+        self.disconnect()
+        return False
+
+    def clear(self):
+        self.queue.clear()
+        self.presence.clear()
+        self.superseded.clear()
+        self.depth = 0
+        self.bytes = 0
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.queue and not self.paused:
+            payload, isBinary, kind, key = entry = self.queue.popleft()
+            if payload is None:
+                continue
+            entry[0] = None
+            self.depth -= 1
+            self.bytes -= len(payload)
+            self.write(payload, isBinary)
+        if not self.depth:
+            self.clear()
+
+    def stopProducing(self):
+        self.clear()
+        self.closed = True
+
+# The kernel grows a socket's send buffer to several MB for a client that
+# stops reading, which swallows everything the queue above is meant to
+# bound.  Fixed this small, the transport's own buffer fills and the queue
+# is paused within a few frames of the client stalling, on either engine.
+SEND_BUFFER = 64 * 1024
+
+def limit_send_buffer(sock, size=SEND_BUFFER):
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+    except OSError:
+        pass
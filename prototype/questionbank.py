@@ -0,0 +1,182 @@
+# Question packs for the games, loaded once and sampled without repeats.
+#
+# A pack is a JSON file holding either a list of questions (the format of
+# the original questions.json) or an object with "questions" and "tags"
+# that apply to all of them; a .jsonl pack has one question per line.  A
+# question is an object with its "choices" and, optionally, "tags".  The
+# pack's name is its file name without the extension.
+#
+# All the packs are loaded into one Index: the questions in a list, with
+# interned strings, and for each pack and tag the question numbers in it.
+# A game takes a Deck from the bank, which draws from the questions it asked
+# for (by tag and pack) in a random order without repeating one until all
+# of them have been drawn.
+#
+# Reloading builds a new Index on a thread and swaps it in when it is done;
+# decks already dealt keep drawing from the index they were dealt from.
+# Parsing one .json file holds the GIL for as long as it takes, so big
+# packs are better as .jsonl, which is parsed a line at a time.
+import glob
+import json
+import os
+import random
+import sys
+import threading
+from array import array
+
+class Question:
+    __slots__ = ('choices', 'tags', 'pack')
+
+    def __init__(self, choices, tags, pack):
+        self.choices = choices
+        self.tags = tags
+        self.pack = pack
+
+def read_pack(path):
+    """The questions in a pack file and the tags for all of them."""
+    with open(path, 'rb') as f:
+        if path.endswith('.jsonl'):
+            return [ json.loads(line) for line in f if line.strip() ], ()
+        pack = json.load(f)
+    if isinstance(pack, list):
+        return pack, ()
+    return pack['questions'], pack.get('tags', ())
+
+def stamp(paths):
+    """When each file was last modified."""
+    return { path: os.stat(path).st_mtime for path in paths }
+
+def pack_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+class Index:
+    def __init__(self, paths):
+        self.questions = []
+        self.packs = {}
+        self.tags = {}
+
+        tag_sets = {}
+        for path in paths:
+            name = sys.intern(pack_name(path))
+            questions, pack_tags = read_pack(path)
+            start = len(self.questions)
+            for q in questions:
+                choices = tuple(sys.intern(c) for c in q['choices'])
+                tags = frozenset(sys.intern(t) for t in list(pack_tags) + q.get('tags', []))
+                # Questions tagged alike share one set of their tags.
+                tags = tag_sets.setdefault(tags, tags)
+                number = len(self.questions)
+                self.questions.append(Question(choices, tags, name))
+                for tag in tags:
+                    self.tags.setdefault(tag, array('I')).append(number)
+            self.packs[name] = range(start, len(self.questions))
+
+    def select(self, tags=None, packs=None):
+        """The numbers of the questions with any of tags, from any of packs;
+        all of them for None."""
+        if packs is None:
+            numbers = range(len(self.questions))
+        else:
+            numbers = [ n for pack in packs for n in self.packs.get(pack, ()) ]
+        if tags is not None:
+            tagged = set()
+            for tag in tags:
+                tagged.update(self.tags.get(tag, ()))
+            numbers = [ n for n in numbers if n in tagged ]
+        return array('I', numbers)
+
+class Deck:
+    def __init__(self, index, numbers, rng=None):
+        if not numbers:
+            raise ValueError("No questions to draw from.")
+        self.index = index
+        self.numbers = numbers
+        self.rng = rng or random
+        self.drawn = 0
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def draw(self):
+        # One step of a Fisher-Yates shuffle per question drawn, so dealing
+        # a deck costs nothing up front however big the pack.  Once every
+        # question has been drawn the next round starts from a new shuffle.
+        numbers = self.numbers
+        if self.drawn == len(numbers):
+            self.drawn = 0
+        i = self.drawn
+        j = self.rng.randrange(i, len(numbers))
+        numbers[i], numbers[j] = numbers[j], numbers[i]
+        self.drawn += 1
+        return self.index.questions[numbers[i]]
+
+class QuestionBank:
+    def __init__(self, sources):
+        # Pack files, and directories to load every pack in.
+        self.sources = list(sources)
+        # When each file was modified as of the last attempt to load it,
+        # successful or not, to tell when to reload.
+        paths = self.pack_files()
+        self.stamps = stamp(paths)
+        self.index = Index(paths)
+        self.loading = None
+        self.watcher = None
+
+    def pack_files(self):
+        paths = []
+        for source in self.sources:
+            if os.path.isdir(source):
+                paths.extend(sorted(glob.glob(os.path.join(source, '*.json')) +
+                    glob.glob(os.path.join(source, '*.jsonl'))))
+            else:
+                paths.append(source)
+        return paths
+
+    def deck(self, tags=None, packs=None, rng=None):
+        index = self.index
+        return Deck(index, index.select(tags, packs), rng)
+
+    def changed(self):
+        stamps = self.stamps
+        paths = self.pack_files()
+        if len(paths) != len(stamps):
+            return True
+        try:
+            return any(stamps.get(path, None) != os.stat(path).st_mtime for path in paths)
+        except OSError:
+            # Caught mid-write or mid-rename; look again next time.
+            return False
+
+    def reload(self):
+        """Loads the packs again on a thread, unless that is already
+        happening; the new index replaces the old one once it is built."""
+        if self.loading is not None and self.loading.is_alive():
+            return
+        self.loading = threading.Thread(target=self.load, daemon=True)
+        self.loading.start()
+
+    def load(self):
+        paths = self.pack_files()
+        try:
+            # Stamped before parsing, so a pack that fails to load is only
+            # tried again once it changes, and a change made while loading
+            # is picked up next time.
+            self.stamps = stamp(paths)
+            index = Index(paths)
+        except Exception as e:
+            print("Question packs not reloaded, keeping the old ones: {}".format(e))
+            return
+        self.index = index
+        print("Reloaded {} questions from {} packs".format(len(index.questions), len(index.packs)))
+
+    def watch(self, clock, interval=5):
+        """Reloads the packs whenever one changes, checking every interval
+        seconds."""
+        if self.changed():
+            self.reload()
+        self.watcher = clock.callLater(interval, self.watch, clock, interval)
+
+    def stop(self):
+        if self.watcher is not None and self.watcher.active():
+            self.watcher.cancel()
+        self.watcher = None
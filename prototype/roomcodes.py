@@ -0,0 +1,110 @@
+# Room code allocation.
+#
+# Codes of each length are handed out by walking a keyed pseudo-random
+# permutation of every code of that length, so a new code never needs to be
+# checked against the rooms in use and allocation costs the same however
+# full the broker is.  The key is secret and new for each length, so seeing
+# some codes says nothing about the next one: the code is the only thing
+# keeping strangers out of a game.  Released codes go on a FIFO free list and are only
+# handed out again once they have been free for reuse_delay seconds, so a
+# phone still holding an old code does not land in a stranger's game.  When
+# nothing is left the allocator moves on to longer codes; once it has, free
+# codes are handed out ahead of the permutation, so the shorter codes come
+# back into use as the rooms holding them close.
+#
+# The first letter of every code is taken from the letters given, which is
+# how sharded brokers keep their codes apart.
+import collections
+import hashlib
+import secrets
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+class Permutation:
+    """A keyed permutation of range(size), as a Feistel network over the
+    smallest even number of bits that holds size."""
+    rounds = 8
+
+    def __init__(self, size, key=None):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.key = key if key is not None else secrets.token_bytes(16)
+
+    def round(self, i, value):
+        digest = hashlib.blake2b(bytes([i]) + value.to_bytes(8, 'little'), digest_size=8,
+                key=self.key).digest()
+        return int.from_bytes(digest, 'little') & self.mask
+
+    def encrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self.round(i, right)
+        return (left << self.half) | right
+
+    def __getitem__(self, index):
+        # The network permutes a power of two; a result past size is put
+        # through again until it lands inside (cycle walking), which keeps
+        # this a permutation of range(size).  The power of two is under
+        # four times size, so that takes a few steps at most on average.
+        value = self.encrypt(index)
+        while value >= self.size:
+            value = self.encrypt(value)
+        return value
+
+class RoomCodeAllocator:
+    def __init__(self, clock, first_letters=ALPHABET, min_length=4, max_length=8, reuse_delay=300):
+        self.clock = clock
+        self.first_letters = first_letters
+        self.min_length = min_length
+        self.max_length = max_length
+        self.reuse_delay = reuse_delay
+        self.free = collections.deque()
+        # Codes in use that did not come from the permutation (restored
+        # rooms); the permutation skips them when it reaches them.
+        self.reserved = set()
+        self.start_length(min_length)
+
+    def start_length(self, length):
+        self.length = length
+        self.size = len(self.first_letters) * len(ALPHABET) ** (length - 1)
+        self.order = Permutation(self.size)
+        self.issued = 0
+
+    def code_at(self, index):
+        first = len(self.first_letters)
+        letters = [self.first_letters[index % first]]
+        index //= first
+        for i in range(self.length - 1):
+            letters.append(ALPHABET[index % len(ALPHABET)])
+            index //= len(ALPHABET)
+        return ''.join(letters)
+
+    def reusable(self):
+        return self.free and self.free[0][1] + self.reuse_delay <= self.clock.seconds()
+
+    def allocate(self):
+        if self.length > self.min_length and self.reusable():
+            return self.free.popleft()[0]
+        while True:
+            if self.issued < self.size:
+                code = self.code_at(self.order[self.issued])
+                self.issued += 1
+                if code in self.reserved:
+                    self.reserved.discard(code)
+                    continue
+                return code
+
+            if self.reusable():
+                return self.free.popleft()[0]
+
+            if self.length >= self.max_length:
+                raise RuntimeError("No room codes available.")
+            self.start_length(self.length + 1)
+
+    def reserve(self, code):
+        self.reserved.add(code)
+
+    def release(self, code):
+        self.free.append((code, self.clock.seconds()))
@@ -0,0 +1,71 @@
+# Answer tallies and leaderboards for games with big rooms.
+#
+# Both are kept up to date as answers and points come in, so finishing a
+# round touches only the players who scored, and reading the leaders does
+# not sort everyone.
+
+class Tally:
+    """The answers to one question, by participant and by answer."""
+
+    def __init__(self):
+        self.answers = {}
+        # Answer id -> the names that gave it.
+        self.voters = {}
+
+    def record(self, name, answer):
+        previous = self.answers.get(name, None)
+        if previous is not None:
+            # Changed their mind; only the last answer counts.
+            self.voters[previous].discard(name)
+        self.answers[name] = answer
+        self.voters.setdefault(answer, set()).add(name)
+
+    def answer_of(self, name):
+        return self.answers.get(name, None)
+
+    def count(self, answer):
+        return len(self.voters.get(answer, ()))
+
+    def gave(self, answer):
+        return self.voters.get(answer, set())
+
+class Leaderboard:
+    """Scores that only go up one point at a time, bucketed by score so that
+    adding a point and reading the top few are both cheap.  Ties are in the
+    order the tied players reached the score."""
+
+    def __init__(self):
+        self.scores = {}
+        # Score -> names with it, as a dict for its ordering.
+        self.buckets = {}
+        self.best = 0
+
+    def add(self, name):
+        if name not in self.scores:
+            self.scores[name] = 0
+            self.buckets.setdefault(0, {})[name] = None
+
+    def score(self, name):
+        return self.scores.get(name, 0)
+
+    def point(self, name):
+        self.add(name)
+        score = self.scores[name]
+        bucket = self.buckets[score]
+        del bucket[name]
+        if not bucket:
+            del self.buckets[score]
+        score += 1
+        self.scores[name] = score
+        self.buckets.setdefault(score, {})[name] = None
+        self.best = max(self.best, score)
+
+    def top(self, k):
+        """Up to k (name, score) pairs, highest score first."""
+        leaders = []
+        for score in range(self.best, -1, -1):
+            for name in self.buckets.get(score, ()):
+                if len(leaders) == k:
+                    return leaders
+                leaders.append((name, score))
+        return leaders
@@ -0,0 +1,153 @@
+# Multi-process broker: rooms sharded between worker processes by room code.
+#
+# The master process owns the listening socket.  For each new connection it
+# peeks (without consuming) at the HTTP request line, picks the worker that
+# owns the room named by a "code" query parameter, and hands the socket
+# itself to that worker over a Unix socket.  The worker adopts it into its
+# own reactor and reads the request as if it had accepted it, so once a
+# connection is placed nothing more crosses between processes.
+#
+# A room's worker is fixed by the first letter of its code, and each worker
+# only generates codes starting with its own letters.  Connections without
+# a code (a Game about to create a room) go to the workers in turn, and a
+# "shard" query parameter names a worker outright.
+import itertools
+import selectors
+import socket
+import subprocess
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import eventlog
+
+log = eventlog.get('shards')
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+MAX_WORKERS = len(ALPHABET)
+HANDOFF_TIMEOUT = 10
+
+def shard_of(code, shards):
+    try:
+        return ALPHABET.index(code[0]) % shards
+    except (IndexError, ValueError):
+        return 0
+
+def shard_letters(shard, shards):
+    return ''.join(c for i, c in enumerate(ALPHABET) if i % shards == shard)
+
+def route(head, shards):
+    line = head.split(b'\r\n', 1)[0].split(b' ')
+    if len(line) < 2:
+        return None
+    query = parse_qs(urlsplit(line[1].decode('latin-1')).query)
+    # Each worker keeps its own metrics and queues, so a scraper names the
+    # one it wants: /metrics?shard=N, /queues?shard=N.
+    shard = query.get('shard', [''])[0]
+    if shard.isdigit() and int(shard) < shards:
+        return int(shard)
+    code = query.get('code', [''])[0].strip().upper()
+    if not code:
+        return None
+    return shard_of(code, shards)
+
+def run_master(port, workers, command):
+    if not 1 < workers <= MAX_WORKERS:
+        raise ValueError("Between 2 and {} workers are supported.".format(MAX_WORKERS))
+
+    listener = socket.create_server(('', port), backlog=1024)
+    listener.setblocking(False)
+
+    channels = []
+    procs = []
+    for i in range(workers):
+        parent, child = socket.socketpair()
+        procs.append(subprocess.Popen(command + ['--workers', str(workers),
+            '--shard', str(i), '--control-fd', str(child.fileno())], pass_fds=[child.fileno()]))
+        child.close()
+        channels.append(parent)
+    log.info('listening', port=port, workers=workers)
+
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    pending = {}
+    turns = itertools.cycle(range(workers))
+
+    try:
+        while True:
+            for key, events in sel.select(timeout=1):
+                if key.fileobj is listener:
+                    try:
+                        conn, addr = listener.accept()
+                    except BlockingIOError:
+                        continue
+                    conn.setblocking(False)
+                    sel.register(conn, selectors.EVENT_READ)
+                    pending[conn] = time.monotonic() + HANDOFF_TIMEOUT
+                    continue
+
+                conn = key.fileobj
+                sel.unregister(conn)
+                del pending[conn]
+                try:
+                    head = conn.recv(4096, socket.MSG_PEEK)
+                except OSError:
+                    head = b''
+                if head:
+                    shard = route(head, workers)
+                    if shard is None:
+                        shard = next(turns)
+                    socket.send_fds(channels[shard], [b'c'], [conn.fileno()])
+                conn.close()
+
+            now = time.monotonic()
+            for conn in [c for c, deadline in pending.items() if deadline < now]:
+                sel.unregister(conn)
+                del pending[conn]
+                conn.close()
+
+            for i, p in enumerate(procs):
+                if p.poll() is not None:
+                    raise RuntimeError("Broker worker {} exited with status {}".format(i, p.returncode))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for p in procs:
+            p.wait()
+
+class HandoffReader:
+    """Adopts the connections the master hands to this worker."""
+
+    def __init__(self, reactor, fd, factory):
+        self.reactor = reactor
+        self.channel = socket.socket(fileno=fd)
+        self.factory = factory
+
+    def start(self):
+        self.reactor.addReader(self)
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def logPrefix(self):
+        return "HandoffReader"
+
+    def doRead(self):
+        msg, fds, flags, addr = socket.recv_fds(self.channel, 1, 1)
+        if not msg:
+            log.warning('master-gone')
+            self.reactor.removeReader(self)
+            self.reactor.stop()
+            return
+        for fd in fds:
+            # adoptStreamConnection duplicates the descriptor; close ours.
+            conn = socket.socket(fileno=fd)
+            try:
+                self.reactor.adoptStreamConnection(conn.fileno(), conn.family, self.factory)
+            finally:
+                conn.close()
+
+    def connectionLost(self, reason):
+        pass
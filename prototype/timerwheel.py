@@ -0,0 +1,75 @@
+# A hashed timer wheel for the broker's housekeeping timeouts.
+#
+# Timeouts here (empty-room grace, unjoined connections) are set and
+# cancelled far more often than they fire, and exact timing does not
+# matter.  Scheduling and cancelling are O(1), and each tick only touches
+# the timers that expire on it.
+import math
+
+import eventlog
+
+log = eventlog.get('timerwheel')
+
+class Timer:
+    def __init__(self, wheel, slot, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.callback = callback
+        self.args = args
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel.slots[self.slot].pop(self, None)
+            self.slot = None
+
+class TimerWheel:
+    def __init__(self, clock, tick=1.0, size=1024):
+        self.clock = clock
+        self.tick = tick
+        # Each slot is a dict used as an insertion-ordered set of timers.
+        self.slots = [ {} for i in range(size) ]
+        self.position = 0
+        self.next_tick = None
+        self.call = None
+
+    def start(self):
+        self.next_tick = self.clock.seconds() + self.tick
+        self.call = self.clock.callLater(self.tick, self.run)
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def run(self):
+        # Ticks are counted from start(), so a late call is caught up on
+        # rather than pushing every later timer back.
+        self.advance()
+        self.next_tick += self.tick
+        self.call = self.clock.callLater(max(0, self.next_tick - self.clock.seconds()), self.run)
+
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, math.ceil(delay / self.tick))
+        if ticks >= len(self.slots):
+            raise ValueError("Timeout of {}s is longer than the timer wheel.".format(delay))
+        slot = (self.position + ticks) % len(self.slots)
+        timer = Timer(self, slot, callback, args)
+        self.slots[slot][timer] = None
+        return timer
+
+    # Lets the wheel stand in for the reactor where only callLater is used.
+    callLater = schedule
+
+    def advance(self):
+        self.position = (self.position + 1) % len(self.slots)
+        due = self.slots[self.position]
+        self.slots[self.position] = {}
+        for timer in due:
+            timer.slot = None
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.error('timer-failed', callback=repr(timer.callback), error=str(e))
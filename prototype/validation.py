@@ -0,0 +1,187 @@
+# Checking incoming commands against schemas/.
+#
+# Each command schema (one whose "command" property has a "const") is
+# compiled once, at startup, into the source of a Python function that
+# tests exactly what the schema asks for, so checking a message runs
+# straight-line code instead of walking the schema.  A check function
+# returns None for a valid message and a description of the first problem
+# otherwise.
+#
+# Only the parts of JSON Schema that schemas/ uses are supported; anything
+# else is an error when compiling rather than silently ignored.
+import glob
+import json
+import os
+import re
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schemas')
+
+MODES = ('strict', 'sampled', 'off')
+
+TYPE_CHECKS = {
+    'string': "isinstance({v}, str)",
+    'number': "isinstance({v}, (int, float)) and not isinstance({v}, bool)",
+    'integer': "isinstance({v}, int) and not isinstance({v}, bool)",
+    'boolean': "isinstance({v}, bool)",
+    'object': "isinstance({v}, dict)",
+    'array': "isinstance({v}, list)",
+}
+IGNORED = {'title', 'description', '$schema'}
+SUPPORTED = IGNORED | {'type', 'const', 'enum', 'minLength', 'maxLength', 'pattern',
+        'properties', 'required', 'items'}
+
+def character_class(pattern):
+    """For a pattern like ^[A-Z]+$, the set of characters allowed and whether
+    at least one is needed; None for anything more complicated."""
+    match = re.fullmatch(r'\^\[([^\]\\^]+)\]([+*])\$', pattern)
+    if match is None:
+        return None
+    characters = set()
+    for start, end in re.findall(r'(.)(?:-(.))?', match.group(1)):
+        characters.update(chr(c) for c in range(ord(start), ord(end or start) + 1))
+    return frozenset(characters), match.group(2) == '+'
+
+class SchemaCompiler:
+    def __init__(self):
+        self.lines = []
+        self.constants = {}
+        self.variables = 0
+
+    def constant(self, value):
+        name = "c{}".format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def variable(self):
+        self.variables += 1
+        return "v{}".format(self.variables)
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def fail(self, indent, condition, message):
+        self.emit(indent, "if {}:".format(condition))
+        self.emit(indent + 1, "return {!r}".format(message))
+
+    def compile(self, schema, v, path, indent):
+        unknown = set(schema) - SUPPORTED
+        if unknown:
+            raise ValueError("{}: unsupported schema keywords {}".format(path, sorted(unknown)))
+
+        kind = schema.get('type', None)
+        if kind is not None:
+            if kind not in TYPE_CHECKS:
+                raise ValueError("{}: unknown type {!r}".format(path, kind))
+            self.fail(indent, "not ({})".format(TYPE_CHECKS[kind].format(v=v)),
+                    "{} must be of type {}".format(path, kind))
+
+        if 'const' in schema:
+            self.fail(indent, "{} != {}".format(v, self.constant(schema['const'])),
+                    "{} must be {!r}".format(path, schema['const']))
+        if 'enum' in schema:
+            self.fail(indent, "{} not in {}".format(v, self.constant(frozenset(schema['enum']))),
+                    "{} must be one of {}".format(path, ', '.join(map(str, schema['enum']))))
+
+        # Keywords for one type do not apply to values of another, which
+        # only needs testing when the schema has not fixed the type already.
+        string = "" if kind == 'string' else "isinstance({}, str) and ".format(v)
+        if 'minLength' in schema:
+            self.fail(indent, "{}len({}) < {}".format(string, v, int(schema['minLength'])),
+                    "{} is shorter than {}".format(path, schema['minLength']))
+        if 'maxLength' in schema:
+            self.fail(indent, "{}len({}) > {}".format(string, v, int(schema['maxLength'])),
+                    "{} is longer than {}".format(path, schema['maxLength']))
+        if 'pattern' in schema:
+            characters = character_class(schema['pattern'])
+            if characters is not None:
+                # A whole string from one character class is a set test,
+                # several times faster than the regular expression.
+                condition = "not {}.issuperset({})".format(self.constant(characters[0]), v)
+                if characters[1]:
+                    condition = "not {} or {}".format(v, condition)
+            else:
+                condition = "{}.search({}) is None".format(self.constant(re.compile(schema['pattern'])), v)
+            self.fail(indent, string + condition, "{} does not match {}".format(path, schema['pattern']))
+
+        if 'required' in schema or 'properties' in schema:
+            body = indent
+            if kind != 'object':
+                self.emit(indent, "if isinstance({}, dict):".format(v))
+                body += 1
+                self.emit(body, "pass")
+            for name in schema.get('required', []):
+                self.fail(body, "{!r} not in {}".format(name, v),
+                        "{} is missing {}".format(path, name))
+            for name, subschema in schema.get('properties', {}).items():
+                sub = self.variable()
+                self.emit(body, "{} = {}.get({!r}, missing)".format(sub, v, name))
+                self.emit(body, "if {} is not missing:".format(sub))
+                self.emit(body + 1, "pass")
+                self.compile(subschema, sub, "{}.{}".format(path, name), body + 1)
+
+        if 'items' in schema:
+            body = indent
+            if kind != 'array':
+                self.emit(indent, "if isinstance({}, list):".format(v))
+                body += 1
+            item = self.variable()
+            self.emit(body, "for {} in {}:".format(item, v))
+            self.emit(body + 1, "pass")
+            self.compile(schema['items'], item, "{}[]".format(path), body + 1)
+
+def compile_schema(schema, name='check'):
+    compiler = SchemaCompiler()
+    compiler.emit(0, "def {}(message):".format(name))
+    compiler.compile(schema, 'message', 'message', 1)
+    compiler.emit(1, "return None")
+    source = '\n'.join(compiler.lines)
+    namespace = dict(compiler.constants, missing=object())
+    exec(compile(source, "<schema {}>".format(name), 'exec'), namespace)
+    check = namespace[name]
+    check.source = source
+    return check
+
+def load_command_checks(directory=SCHEMA_DIR):
+    checks = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        with open(path) as f:
+            schema = json.load(f)
+        command = schema.get('properties', {}).get('command', {}).get('const', None)
+        if command is not None:
+            checks[command] = compile_schema(schema, command.replace('-', '_'))
+    return checks
+
+class Validator:
+    """Checks incoming messages in one of three modes: every message
+    (strict), one in every sample_every messages (sampled) or none (off)."""
+
+    def __init__(self, mode='strict', sample_every=100, directory=SCHEMA_DIR):
+        if mode not in MODES:
+            raise ValueError("Unknown validation mode {}".format(mode))
+        self.mode = mode
+        self.sample_every = sample_every
+        self.checks = load_command_checks(directory)
+        self.seen = 0
+        self.checked = 0
+        self.rejected = 0
+        # Picked once here rather than tested on every message.
+        self.check = getattr(self, 'check_' + mode)
+
+    def check_strict(self, data):
+        check = self.checks.get(data['command'], None)
+        if check is None:
+            return None
+        self.checked += 1
+        error = check(data)
+        if error is not None:
+            self.rejected += 1
+        return error
+
+    def check_sampled(self, data):
+        self.seen += 1
+        if self.seen % self.sample_every:
+            return None
+        return self.check_strict(data)
+
+    def check_off(self, data):
+        return None
@@ -1,55 +1,78 @@
 #/usr/bin/env python3
 # requires autobahn, Twisted
 
-import json
-import random
-from twisted.internet.endpoints import clientFromString
-from autobahn.twisted.websocket import WebSocketClientFactory
-from autobahn.twisted.websocket import WebSocketClientProtocol
+import html
+import sys
 
+import gamehost
+import questionbank
+import scoring
 from messages import CreateRoomMessage, StaticMessage, SimpleMultiChoiceQuestion
 
 class Player:
+    __slots__ = ('name', 'pending_question', 'connected')
+
     def __init__(self, name):
-        self.name = name
-        self.score = 0
+        self.name = sys.intern(name)
         self.pending_question = None
-        self.answer_id = None
+        self.connected = True
 
 
 class WouldYouRather:
-    required_capabilities = ['multi-choice', 'static-message']
-    def __init__(self):
+    required_capabilities = ['multi-choice', 'static-message', 'participant-roster']
+    # Seconds before the first round, the longest a round waits for
+    # answers, and how long the results show before the next round.
+    start_delay = 10
+    answer_time = 30
+    results_time = 15
+    # How many of the leaders the results show.
+    leaders_shown = 5
+
+    def __init__(self, bank, tags=None, packs=None, audience=False):
         self.players = {}
         self.vip_player = None
         self.room = None
         self.game_started = False
-
-    def connect(self, endpoint, wsurl):
-        from twisted.internet import reactor
-        wsfactory = ClientFactory(wsurl)
-        wsfactory.game = self 
-        wsclient = clientFromString(reactor, endpoint)
-        wsclient.connect(wsfactory)
-
-    def onOpen(self):
-        create_room = CreateRoomMessage(self.required_capabilities, "Would You Rather 0.1", "WouldYouRather?")
+        self.bank = bank
+        self.tags = tags
+        self.packs = packs
+        self.deck = None
+        # The round's question, the players yet to answer it, and the call
+        # that ends the round if they have not by then.
+        self.question_id = None
+        self.outstanding = set()
+        self.deadline = None
+        # This round's answers and the game's scores, kept as answers come
+        # in so the results cost the same however many are playing.
+        self.tally = scoring.Tally()
+        self.leaderboard = scoring.Leaderboard()
+        self.capabilities = list(self.required_capabilities)
+        # With an audience the broker sends a tally of its votes on the
+        # round's question now and then (capabilities/audience.rst).
+        if audience:
+            self.capabilities.append('audience')
+        self.audience_tally = None
+        # Set by the GameHost running this game.
+        self.connection = None
+        self.clock = None
+
+    def create_room(self):
+        create_room = CreateRoomMessage(self.capabilities, "Would You Rather 0.1", "WouldYouRather?")
         self.connection.sendMessage( create_room.encode() )
-        print("Connection to broker established")
 
-    def onMessage(self, payload, isBinary):
-        print("Received message: {}".format(payload))
-        if isBinary:
-            return
-
-        msgdata = json.loads(payload.decode('utf-8'))
+    def handle(self, msgdata):
         command = msgdata.get('command', None)
         if command == 'create-room-response':
             self.room_created(msgdata)
         elif command == 'participant-status':
             self.onParticipantStatus(msgdata)
+        elif command == 'participant-roster':
+            self.onParticipantRoster(msgdata)
         elif command == 'participant-message':
             self.onParticipantMessage(msgdata)
+        elif command == 'audience-tally':
+            if msgdata['question-identifier'] == self.question_id:
+                self.audience_tally = msgdata
         else:
             print("Command {} unhandled".format(command))
 
@@ -63,11 +86,16 @@ class WouldYouRather:
                        self.start_game()
                 else:
                     print("Got message that answers a question not asked?")
+            elif msg['question-identifier'] != self.question_id:
+                print("Ignoring answer from {} to a question no longer open.".format(source))
             else:
                 answer_id = msg.get('selection', {}).get("answer-identifier", None)
                 if source in self.players:
-                    self.players[source].answer_id = answer_id
+                    self.tally.record(source, answer_id)
                 self.wait_message(source)
+                self.outstanding.discard(source)
+                if not self.outstanding:
+                    self.collect_answers()
         else:
             print("Got non answer message.")
 
@@ -87,6 +115,10 @@ class WouldYouRather:
         m = StaticMessage(self.room, name, "Hold tight while we wait for <em>everyone</em>.", is_html=True)
         self.connection.sendMessage( m.encode() )
 
+    def onParticipantRoster(self, msgdata):
+        for entry in msgdata.get('participants', []):
+            self.onParticipantStatus(entry)
+
     def onParticipantStatus(self, msgdata):
         name = msgdata.get('participant-name', None)
         status = msgdata.get('presence', None)
@@ -111,124 +143,184 @@ class WouldYouRather:
             else:
                 if status == "disconnected":
                     print("Player {} disconnected".format(name))
+                    self.players[name].connected = False
+                    # Nobody waits on a player who has gone.
+                    if name in self.outstanding:
+                        self.outstanding.discard(name)
+                        if not self.outstanding:
+                            self.collect_answers()
                 else:
                     print("Player {} rejoined".format(name))
+                    self.players[name].connected = True
 
     def start_game(self):
         self.game_started = True
         print("Game starting.")
-        for player in self.players:
-            m = StaticMessage(self.room, player, "Starting game...")
-            self.connection.sendMessage( m.encode() )
+        # Dealt from the packs as they are now; a reload mid-game does not
+        # change the questions this game draws from.
+        self.deck = self.bank.deck(self.tags, self.packs)
+        for player in self.players.values():
+            self.leaderboard.add(player.name)
+        m = StaticMessage(self.room, None, "Starting game...")
+        self.connection.sendMessage( m.encode() )
         self.player_turns = iter(self.players)
 
-        self.connection.factory.reactor.callLater(10, self.start_round)
+        self.clock.callLater(self.start_delay, self.start_round)
 
     def start_round(self):
         try:
             self.current_player = next(self.player_turns)
             self.current_question = self.get_question()
             print("{} is the current judge.".format(self.current_player))
-            q = self.judge_question(self.current_player, self.current_question)
-            for player in self.players:
-                if player != self.current_player:
-                    self.rest_question(player, q)
-            self.connection.factory.reactor.callLater(30, self.collect_answers)
+            q = SimpleMultiChoiceQuestion(self.room, None, "What would {} rather?".format(self.current_player),
+                    self.current_question.choices)
+            self.tally = scoring.Tally()
+            self.audience_tally = None
+            self.rest_question(q)
+            self.judge_question(self.current_player, q)
+            # The judge's answer decides the round, so they are waited on too.
+            self.question_id = q.question_id
+            self.outstanding = { name for name, player in self.players.items() if player.connected }
+            if not self.outstanding:
+                self.collect_answers()
+                return
+            self.deadline = self.clock.callLater(self.answer_time, self.collect_answers)
         except StopIteration:
             print("Game is over, all players have had a round.")
             self.end_game()
 
     def end_game(self):
         for player in self.players:
-            score = self.players[player].score
+            score = self.leaderboard.score(player)
             m = StaticMessage(self.room, player, "Your score is {}".format(score))
             self.connection.sendMessage(m.encode())
         self.game_started = False
 
-    def judge_question(self, player, question):
-        m = SimpleMultiChoiceQuestion(self.room, player, "Would you rather?", 
-                question['choices'])
+    def judge_question(self, player, m):
+        m.prompt = "Would you rather?"
+        m.participant = player
         self.players[player].pending_question = m
         self.connection.sendMessage( m.encode() )
-        return m
 
-    def rest_question(self, player, m):
-        m.prompt = "What would {} rather?".format(self.current_player)
-        m.participant = player
-        self.players[player].pending_question = m
+    def rest_question(self, m):
+        # One broadcast for everyone; the judge's own question replaces it.
+        for player in self.players:
+            self.players[player].pending_question = m
         self.connection.sendMessage( m.encode() )
 
     def collect_answers(self):
-        print("Times up to answer, examining answers.")
-        correct_answer = self.players[self.current_player].answer_id
+        # Either everyone has answered or time is up; whichever came second
+        # finds the round already over.
+        if self.question_id is None:
+            return
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+        if self.outstanding:
+            print("Times up to answer, {} did not.".format(len(self.outstanding)))
+        self.question_id = None
+        self.outstanding = set()
+        print("Examining answers.")
+        judge = self.current_player
+        question = self.players[judge].pending_question
+        correct_answer = self.tally.answer_of(judge)
         answer_label = None
-        for c in self.players[self.current_player].pending_question.choices:
+        for c in question.choices:
             if c['answer-identifier'] == correct_answer:
                 answer_label = c['label']
                 break
         else:
             answer_label = "Answer not found!?"
 
-        correct = []
-        incorrect = []
-        for player in self.players:
-            if player == self.current_player:
-                continue
-            
-            if self.players[player].answer_id == correct_answer:
-                print("{} guessed correctly!".format(player))
-                correct.append(player)
-                self.players[player].score += 1
-            else:
-                print("{} guessed incorrectly!".format(player))
-                incorrect.append(player)
+        # No answer is never right, even when the judge gave none either.
+        if correct_answer is None:
+            correct = set()
+        else:
+            correct = self.tally.gave(correct_answer) - {judge}
+        incorrect = len(self.players) - 1 - len(correct)
 
         print("The correct answer was {} ({}), {} got it right, {} got it wrong.".format(
-            answer_label, correct_answer, correct, incorrect))
+            answer_label, correct_answer, len(correct), incorrect))
 
-        correct_msg = '<span style="color:green">Correct!</span> {} got it right, {} got it wrong.'.format(correct, incorrect)
-        incorrect_msg = '<span style="color:red">Incorrect!</span> {} got it right, {} got it wrong.'.format(correct, incorrect)
-        judge_msg = 'You were the judge this round. {} got it right, {} got it wrong.'.format(correct, incorrect)
-
-        for player in correct:
-            self.connection.sendMessage( StaticMessage(self.room, player, correct_msg, is_html=True).encode() )
+        # A word to each player, then the results once for everyone.
+        correct_msg = '<span style="color:green">Correct!</span>'
+        incorrect_msg = '<span style="color:red">Incorrect!</span>'
+        judge_msg = 'You were the judge this round.'
+        for player in self.players:
+            if player == judge:
+                verdict = judge_msg
+            elif player in correct:
+                # In the order they joined, which settles ties on the board.
+                self.leaderboard.point(player)
+                verdict = correct_msg
+            else:
+                verdict = incorrect_msg
+            self.connection.sendMessage( StaticMessage(self.room, player, verdict, is_html=True).encode() )
 
-        for player in incorrect:
-            self.connection.sendMessage( StaticMessage(self.room, player, incorrect_msg, is_html=True).encode() )
+        self.connection.sendMessage( StaticMessage(self.room, None,
+            self.results(judge, question, correct_answer, answer_label, len(correct), incorrect),
+            is_html=True, append=True).encode() )
 
-        self.connection.sendMessage( StaticMessage(self.room, self.current_player, judge_msg).encode() )
+        self.clock.callLater(self.results_time, self.start_round)
 
-        self.connection.factory.reactor.callLater(15, self.start_round)
+    def results(self, judge, question, correct_answer, answer_label, correct, incorrect):
+        if correct_answer is None:
+            lines = [ "{} did not answer.".format(html.escape(judge)) ]
+        else:
+            lines = [ "{} would rather <b>{}</b>.".format(html.escape(judge), html.escape(answer_label)) ]
+        counts = []
+        for c in question.choices:
+            count = self.tally.count(c['answer-identifier'])
+            if c['answer-identifier'] == correct_answer:
+                count -= 1
+            counts.append("{}: {}".format(html.escape(c['label']), count))
+        lines.append(", ".join(counts))
+        lines.append("{} got it right, {} got it wrong.".format(correct, incorrect))
+        if self.audience_tally is not None:
+            votes = { t['answer-identifier']: t['count'] for t in self.audience_tally['tallies'] }
+            lines.append("The audience said " + ", ".join("{}: {}".format(html.escape(c['label']),
+                votes.get(c['answer-identifier'], 0)) for c in question.choices))
+        leaders = self.leaderboard.top(self.leaders_shown)
+        lines.append("Leaders: " + ", ".join("{} {}".format(html.escape(name), score) for name, score in leaders))
+        return "<br>".join(lines)
 
     def get_question(self):
-        with open('questions.json', 'rb') as qfile:
-            qs = json.load(qfile)
-            return random.choice(qs)
-
-
-class Client(WebSocketClientProtocol):
-    def onOpen(self):
-        self.game = self.factory.game
-        self.game.connection = self
-        self.game.onOpen()
-
-    def onMessage(self, payload, isBinary):
-        self.game.onMessage(payload, isBinary)
-
-class ClientFactory(WebSocketClientFactory):
-    protocol = Client
+        return self.deck.draw()
 
 def main():
+    import argparse
     import sys
     from twisted.python import log
     from autobahn.twisted.choosereactor import install_reactor
 
+    parser = argparse.ArgumentParser(description="Would You Rather? for Party Box")
+    parser.add_argument('--questions', nargs='+', default=['questions.json'],
+            help="question pack files, or directories of them")
+    parser.add_argument('--tag', action='append', dest='tags',
+            help="only ask questions with this tag (or any other --tag)")
+    parser.add_argument('--pack', action='append', dest='packs',
+            help="only ask questions from this pack (or any other --pack)")
+    parser.add_argument('--rooms', type=int, default=1,
+            help="how many games to run, each in its own room")
+    parser.add_argument('--connections', type=int, default=1,
+            help="how many broker connections to spread the games over")
+    parser.add_argument('--audience', action='store_true',
+            help="let the rooms have an audience, whose votes show with the results")
+    parser.add_argument('--endpoint', default="tcp:game.enimihil.net:80")
+    parser.add_argument('--url', default="ws://game.enimihil.net/ws")
+    args = parser.parse_args()
+
     reactor = install_reactor()
 
     log.startLogging(sys.stdout)
 
-    game = WouldYouRather()
-    game.connect("tcp:game.enimihil.net:80", "ws://game.enimihil.net/ws")
+    bank = questionbank.QuestionBank(args.questions)
+    bank.watch(reactor)
+
+    # The games share the question bank; each deals its own deck from it.
+    games = [ WouldYouRather(bank, args.tags, args.packs, args.audience) for i in range(args.rooms) ]
+    host = gamehost.GameHost(games, min(args.connections, args.rooms), reactor)
+    host.connect(args.endpoint, args.url)
 
     reactor.run()
 